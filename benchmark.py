@@ -0,0 +1,387 @@
+#   Domato - benchmark script
+#   --------------------------------------
+#
+#   Copyright 2017 Google Inc. All Rights Reserved.
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+from __future__ import print_function
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from grammar import Grammar
+
+_ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+_TARGETS = [
+    'rules',
+    'php',
+    'canvas',
+    'webgl',
+    'webgpu',
+    'jscript',
+    'vbscript',
+    'mathml3_legacy'
+]
+
+# For every metric, whether a higher value is better.
+_METRICS = [
+    ('parse_time', False),
+    ('samples_per_sec', True),
+    ('bytes_per_sec', True),
+    ('peak_rss', False),
+    ('p50_latency', False),
+    ('p99_latency', False)
+]
+
+# Marks the line with the results of a target on the output of a worker.
+_RESULT_PREFIX = 'BENCHMARK_RESULT '
+
+
+def _load_module(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _read_file(path):
+    with open(path) as f:
+        return f.read()
+
+
+def _load_simple_target(directory, grammar_file, template_file,
+                        function_name):
+    """Loads a target whose generator has a single grammar."""
+    target_dir = os.path.join(_ROOT_DIR, directory)
+    module = _load_module('generator_' + directory,
+                          os.path.join(target_dir, 'generator.py'))
+    template = module.parse_template(
+        _read_file(os.path.join(target_dir, template_file)))
+    grammar = Grammar()
+    if grammar.parse_from_file(os.path.join(target_dir, grammar_file)) > 0:
+        return None
+    grammar.compile_rules()
+    generate_new_sample = getattr(module, function_name)
+    return lambda: generate_new_sample(template, grammar)
+
+
+def _load_rules_target():
+    module = _load_module('generator_rules',
+                          os.path.join(_ROOT_DIR, 'generator.py'))
+    template = module.parse_template(
+        _read_file(os.path.join(_ROOT_DIR, 'template.html')))
+    grammars = module.load_grammars()
+    if grammars is None:
+        return None
+    htmlgrammar, cssgrammar, jsgrammar, _ = grammars
+    return lambda: module.generate_new_sample(template, htmlgrammar,
+                                              cssgrammar, jsgrammar)
+
+
+def _load_webgpu_target():
+    target_dir = os.path.join(_ROOT_DIR, 'webgpu')
+    module = _load_module('generator_webgpu',
+                          os.path.join(target_dir, 'generator.py'))
+    loaded = module.load_grammar('template.html', target_dir)
+    if loaded is None:
+        return None
+    template, grammar = loaded
+    return lambda: module.generate_new_sample(template, grammar)
+
+
+def _load_mathml_target():
+    cssgrammar = Grammar()
+    if cssgrammar.parse_from_file(
+            os.path.join(_ROOT_DIR, 'rules', 'css.txt')) > 0:
+        return None
+    mathmlgrammar = Grammar()
+    mathmlgrammar.add_import('cssgrammar', cssgrammar)
+    if mathmlgrammar.parse_from_file(
+            os.path.join(_ROOT_DIR, 'mathml3_legacy', 'mathml.txt')) > 0:
+        return None
+    return lambda: mathmlgrammar.generate_symbol('mathelement_math')
+
+
+def load_target(name):
+    """Parses the grammars of a target.
+
+    Returns:
+        A function that generates a sample as a string or None if there
+        were errors parsing the grammars.
+    """
+    if name == 'rules':
+        return _load_rules_target()
+    elif name == 'php':
+        return _load_simple_target('php', 'php.txt', 'template.php',
+                                   'generate_new_sample')
+    elif name == 'canvas':
+        return _load_simple_target('canvas', 'canvas.txt', 'template.html',
+                                   'GenerateNewSample')
+    elif name == 'webgl':
+        return _load_simple_target('webgl', 'webgl.txt', 'template.html',
+                                   'GenerateNewSample')
+    elif name == 'webgpu':
+        return _load_webgpu_target()
+    elif name == 'jscript':
+        return _load_simple_target('jscript', 'jscript.txt', 'template.html',
+                                   'GenerateNewSample')
+    elif name == 'vbscript':
+        return _load_simple_target('vbscript', 'vbscript.txt',
+                                   'template.html', 'GenerateNewSample')
+    elif name == 'mathml3_legacy':
+        return _load_mathml_target()
+    raise ValueError('Unknown target ' + name)
+
+
+def get_percentile(sorted_values, percentile):
+    """Returns a percentile of a sorted list (nearest-rank method).
+
+    Returns None for an empty list.
+    """
+    if not sorted_values:
+        return None
+    rank = int(len(sorted_values) * percentile / 100.0 + 0.5)
+    return sorted_values[min(max(rank, 1), len(sorted_values)) - 1]
+
+
+def _get_peak_rss():
+    """Returns the peak resident set size of this process in bytes."""
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    if sys.platform != 'darwin':
+        peak_rss *= 1024
+    return peak_rss
+
+
+def run_target(name, num_samples, seed):
+    """Benchmarks a single target in the current process.
+
+    Sample i is generated after seeding the random module with seed + i,
+    so the same samples get generated on every run.
+
+    Returns:
+        A dictionary with the results.
+    """
+    # The grammars and generators print warnings, keep them out of the
+    # results.
+    with contextlib.redirect_stdout(io.StringIO()):
+        random.seed(seed)
+        start = time.perf_counter()
+        generate = load_target(name)
+        parse_time = time.perf_counter() - start
+        if generate is None:
+            raise Exception('There were errors parsing the grammars of ' +
+                            name)
+
+        latencies = []
+        total_bytes = 0
+        for i in range(num_samples):
+            random.seed(seed + i)
+            start = time.perf_counter()
+            sample = generate()
+            latencies.append(time.perf_counter() - start)
+            total_bytes += len(sample.encode('utf-8', 'surrogatepass'))
+
+    total_time = sum(latencies)
+    latencies.sort()
+    return {
+        'parse_time': parse_time,
+        'samples_per_sec': num_samples / total_time,
+        'bytes_per_sec': total_bytes / total_time,
+        'peak_rss': _get_peak_rss(),
+        'p50_latency': get_percentile(latencies, 50),
+        'p99_latency': get_percentile(latencies, 99)
+    }
+
+
+def run_benchmark(targets, num_samples, seed):
+    """Benchmarks each target in a fresh Python process.
+
+    A separate process per target keeps the peak RSS of one target from
+    hiding the others and makes the parse times independent of the order
+    of the targets. Targets whose process fails are reported and listed
+    under 'failed' instead of 'results'.
+    """
+    results = {}
+    failed = []
+    for name in targets:
+        print('Benchmarking ' + name)
+        try:
+            output = subprocess.check_output([
+                sys.executable, os.path.abspath(__file__),
+                '--run_target', name,
+                '--samples', str(num_samples),
+                '--seed', str(seed)
+            ], universal_newlines=True)
+        except subprocess.CalledProcessError as e:
+            print('Error benchmarking ' + name + ': exit status ' +
+                  str(e.returncode))
+            failed.append(name)
+            continue
+        for line in output.splitlines():
+            if line.startswith(_RESULT_PREFIX):
+                results[name] = json.loads(line[len(_RESULT_PREFIX):])
+        if name not in results:
+            print('Error benchmarking ' + name + ': no results')
+            failed.append(name)
+    return {
+        'python': platform.python_version(),
+        'samples': num_samples,
+        'seed': seed,
+        'results': results,
+        'failed': failed
+    }
+
+
+def _format_value(metric, value):
+    if value is None:
+        return '-'
+    if metric == 'parse_time':
+        return '%.3fs' % value
+    elif metric == 'samples_per_sec':
+        return '%.2f/s' % value
+    elif metric == 'bytes_per_sec':
+        return '%.2fMB/s' % (value / 1e6)
+    elif metric == 'peak_rss':
+        return '%.1fMB' % (value / 1e6)
+    return '%.1fms' % (value * 1000)
+
+
+def print_results(run):
+    print('%-16s' % 'target' +
+          ''.join('%16s' % metric for metric, _ in _METRICS))
+    for name, result in sorted(run['results'].items()):
+        print('%-16s' % name + ''.join(
+            '%16s' % _format_value(metric, result[metric])
+            for metric, _ in _METRICS))
+
+
+def compare_runs(old_run, new_run, threshold):
+    """Prints the relative change of every metric between two runs.
+
+    Returns:
+        The number of metrics that got worse by more than threshold.
+    """
+    if (old_run['samples'] != new_run['samples'] or
+            old_run['seed'] != new_run['seed']):
+        print('Warning: the runs used different sample counts or seeds')
+
+    regressions = 0
+    for name, new_result in sorted(new_run['results'].items()):
+        if name not in old_run['results']:
+            continue
+        old_result = old_run['results'][name]
+        for metric, higher_is_better in _METRICS:
+            old_value = old_result.get(metric)
+            new_value = new_result.get(metric)
+            if not old_value or new_value is None:
+                continue
+            change = (new_value - old_value) / float(old_value)
+            if higher_is_better:
+                regressed = change < -threshold
+            else:
+                regressed = change > threshold
+            if regressed:
+                regressions += 1
+            print('%-16s%-16s%16s -> %-16s%+7.1f%%%s' % (
+                name, metric,
+                _format_value(metric, old_value),
+                _format_value(metric, new_value),
+                change * 100,
+                '  REGRESSION' if regressed else ''))
+    return regressions
+
+
+def get_argument_parser():
+
+    parser = argparse.ArgumentParser(description="DOMATO benchmark")
+
+    parser.add_argument('-t', '--targets', nargs='+', choices=_TARGETS,
+                    default=_TARGETS,
+                    help='targets to benchmark (all of them by default)')
+
+    parser.add_argument('-n', '--samples', type=int, default=20,
+                    help='number of samples to generate per target')
+
+    parser.add_argument('-s', '--seed', type=int, default=0,
+                    help='seed of the first sample')
+
+    parser.add_argument('-o', '--output', type=str,
+                    help='file to store the results in (JSON)')
+
+    parser.add_argument('-c', '--compare', nargs='+', metavar='RESULTS',
+                    help='compare the results with an earlier run; with two result files, compare them without running the benchmark')
+
+    parser.add_argument('--threshold', type=float, default=0.1,
+                    help='relative change that counts as a regression (default 0.1)')
+
+    parser.add_argument('--run_target', choices=_TARGETS,
+                    help=argparse.SUPPRESS)
+    return parser
+
+
+def main():
+
+    parser = get_argument_parser()
+
+    args = parser.parse_args()
+
+    if args.run_target:
+        result = run_target(args.run_target, args.samples, args.seed)
+        print(_RESULT_PREFIX + json.dumps(result))
+        return 0
+
+    if args.compare and len(args.compare) > 2:
+        parser.error('--compare takes one or two result files')
+
+    if args.compare and len(args.compare) == 2:
+        with open(args.compare[0]) as f:
+            old_run = json.load(f)
+        with open(args.compare[1]) as f:
+            new_run = json.load(f)
+    else:
+        new_run = run_benchmark(args.targets, args.samples, args.seed)
+        print_results(new_run)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(new_run, f, indent=2, sort_keys=True)
+        if not args.compare:
+            return 1 if new_run['failed'] else 0
+        with open(args.compare[0]) as f:
+            old_run = json.load(f)
+
+    regressions = compare_runs(old_run, new_run, args.threshold)
+    print(str(regressions) + ' regressions')
+    return 1 if regressions or new_run.get('failed') else 0
+
+
+if __name__ == '__main__':
+
+    sys.exit(main())
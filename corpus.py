@@ -0,0 +1,354 @@
+#   Domato - corpus archives
+#   --------------------------------------
+#
+#   Copyright 2017 Google Inc. All Rights Reserved.
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Packs generated samples into a single indexed archive file.
+
+Layout of an archive (all integers little-endian):
+
+    header:  _MAGIC
+    records: for every sample, a _RECORD_HEADER (seed, codec, size)
+             followed by size bytes of (possibly compressed) sample data
+    index:   an _INDEX_ENTRY (seed, codec, offset, size) for every record,
+             where offset is the position of the data of the record
+    footer:  _FOOTER (offset of the index, number of records, _INDEX_MAGIC)
+
+Samples are numbered in the order they were added, starting at 0. The
+index is written when the archive is closed. If that never happens, the
+index is rebuilt from the record headers when the archive is opened
+again, dropping a partially written last record.
+"""
+
+from __future__ import print_function
+import argparse
+import gzip
+import os
+import struct
+import sys
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+_MAGIC = b'DOMATOA1'
+_INDEX_MAGIC = b'DOMATOIX'
+
+_RECORD_HEADER = struct.Struct('<QBQ')
+_INDEX_ENTRY = struct.Struct('<QBQQ')
+_FOOTER = struct.Struct('<QQ8s')
+
+# Compression of the records, by name and by the id stored in the archive.
+_CODECS = {
+    None: 0,
+    'gzip': 1,
+    'zstd': 2
+}
+_CODEC_NAMES = dict((codec, name) for name, codec in _CODECS.items())
+
+_GZIP_LEVEL = 6
+_ZSTD_LEVEL = 3
+
+
+class CorpusError(Exception):
+    """An exception class for invalid or unreadable archives."""
+    pass
+
+
+def _compress(data, codec):
+    if codec == _CODECS['gzip']:
+        # A fixed mtime keeps archives of the same samples identical.
+        return gzip.compress(data, _GZIP_LEVEL, mtime=0)
+    elif codec == _CODECS['zstd']:
+        return zstandard.ZstdCompressor(level=_ZSTD_LEVEL).compress(data)
+    return data
+
+
+def _decompress(data, codec):
+    if codec == _CODECS['gzip']:
+        return gzip.decompress(data)
+    elif codec == _CODECS['zstd']:
+        if zstandard is None:
+            raise CorpusError('Reading zstd records requires the zstandard '
+                              'module')
+        return zstandard.ZstdDecompressor().decompress(data)
+    elif codec != _CODECS[None]:
+        raise CorpusError('Unknown record compression ' + str(codec))
+    return data
+
+
+def _read_index(f):
+    """Reads the index of an open archive.
+
+    Returns:
+        An (entries, end) tuple with the list of (seed, codec, offset, size)
+        index entries and the end of the last record.
+    """
+    if f.read(len(_MAGIC)) != _MAGIC:
+        raise CorpusError('Not a corpus archive')
+    file_size = f.seek(0, os.SEEK_END)
+
+    if file_size >= len(_MAGIC) + _FOOTER.size:
+        f.seek(file_size - _FOOTER.size)
+        index_offset, count, magic = _FOOTER.unpack(f.read(_FOOTER.size))
+        if (magic == _INDEX_MAGIC and index_offset +
+                count * _INDEX_ENTRY.size + _FOOTER.size == file_size):
+            f.seek(index_offset)
+            data = f.read(count * _INDEX_ENTRY.size)
+            entries = [
+                _INDEX_ENTRY.unpack_from(data, i * _INDEX_ENTRY.size)
+                for i in range(count)
+            ]
+            return entries, index_offset
+
+    # No index, the archive wasn't closed. Walk the records instead.
+    entries = []
+    position = len(_MAGIC)
+    f.seek(position)
+    while True:
+        header = f.read(_RECORD_HEADER.size)
+        if len(header) < _RECORD_HEADER.size:
+            break
+        seed, codec, size = _RECORD_HEADER.unpack(header)
+        offset = position + _RECORD_HEADER.size
+        if codec not in _CODEC_NAMES or offset + size > file_size:
+            break
+        entries.append((seed, codec, offset, size))
+        position = offset + size
+        f.seek(position)
+    return entries, position
+
+
+class CorpusWriter(object):
+    """Appends samples to an archive.
+
+    An existing archive is extended, the new samples get the following
+    numbers.
+
+    Usage example:
+    >>> with CorpusWriter('corpus.dca', 'gzip') as writer:
+    ...     writer.add(sample_bytes, seed)
+    """
+
+    def __init__(self, filename, compression=None):
+        """Opens an archive for appending.
+
+        Args:
+            filename: The archive file, created if it doesn't exist.
+            compression: None, 'gzip' or 'zstd' (which requires the
+                zstandard module). Applies to the records added by this
+                writer.
+        """
+        if compression not in _CODECS:
+            raise ValueError('Unknown compression ' + str(compression))
+        if compression == 'zstd' and zstandard is None:
+            raise CorpusError('zstd compression requires the zstandard '
+                              'module')
+        self._codec = _CODECS[compression]
+        if os.path.exists(filename) and os.path.getsize(filename):
+            self._file = open(filename, 'r+b')
+            self._entries, end = _read_index(self._file)
+            # The index gets written again on close.
+            self._file.seek(end)
+            self._file.truncate()
+        else:
+            self._file = open(filename, 'wb')
+            self._file.write(_MAGIC)
+            self._entries = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, data, seed=0):
+        """Appends a sample.
+
+        Args:
+            data: The sample as bytes.
+            seed: The 64-bit seed the sample was generated from.
+
+        Returns:
+            The number of the sample.
+        """
+        data = _compress(data, self._codec)
+        self._file.write(_RECORD_HEADER.pack(seed, self._codec, len(data)))
+        offset = self._file.tell()
+        self._file.write(data)
+        self._entries.append((seed, self._codec, offset, len(data)))
+        return len(self._entries) - 1
+
+    def close(self):
+        if self._file.closed:
+            return
+        try:
+            index_offset = self._file.tell()
+            self._file.write(b''.join(
+                _INDEX_ENTRY.pack(*entry) for entry in self._entries))
+            self._file.write(_FOOTER.pack(index_offset, len(self._entries),
+                                          _INDEX_MAGIC))
+        finally:
+            self._file.close()
+
+
+class CorpusReader(object):
+    """Reads samples from an archive.
+
+    Samples can be read by number or by seed, or iterated over in order.
+
+    Usage example:
+    >>> with CorpusReader('corpus.dca') as reader:
+    ...     for number, seed, data in reader:
+    ...         run_test(data)
+    """
+
+    def __init__(self, filename):
+        self._file = open(filename, 'rb')
+        try:
+            self._entries, _ = _read_index(self._file)
+        except Exception:
+            self._file.close()
+            raise
+        self._numbers_by_seed = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        for number in range(len(self._entries)):
+            yield number, self._entries[number][0], self.get(number)
+
+    def get(self, number):
+        """Returns the sample with the given number as bytes."""
+        _, codec, offset, size = self._entries[number]
+        self._file.seek(offset)
+        return _decompress(self._file.read(size), codec)
+
+    def get_info(self, number):
+        """Returns the seed, compression and stored size of a sample."""
+        seed, codec, _, size = self._entries[number]
+        return seed, _CODEC_NAMES[codec], size
+
+    def find_seed(self, seed):
+        """Returns the number of the sample with the given seed.
+
+        Raises:
+            KeyError: If there is no such sample.
+        """
+        if self._numbers_by_seed is None:
+            self._numbers_by_seed = dict(
+                (entry[0], number)
+                for number, entry in enumerate(self._entries))
+        return self._numbers_by_seed[seed]
+
+    def extract(self, out_dir, numbers=None, extension='.html'):
+        """Writes samples to files named like the ones of generator.py.
+
+        Args:
+            out_dir: The output directory, created if it doesn't exist.
+            numbers: The numbers of the samples to extract, all by default.
+            extension: The extension of the files.
+
+        Returns:
+            The list of the written files.
+        """
+        if not os.path.exists(out_dir):
+            os.mkdir(out_dir)
+        if numbers is None:
+            numbers = range(len(self._entries))
+        outfiles = []
+        for number in numbers:
+            outfile = os.path.join(
+                out_dir, 'fuzz-' + str(number).zfill(5) + extension)
+            with open(outfile, 'wb') as f:
+                f.write(self.get(number))
+            outfiles.append(outfile)
+        return outfiles
+
+    def close(self):
+        self._file.close()
+
+
+def get_argument_parser():
+
+    parser = argparse.ArgumentParser(description="DOMATO corpus archives")
+
+    parser.add_argument('archive', help='the archive file')
+
+    parser.add_argument('-l', '--list', action='store_true',
+                    help='list the number, seed, compression and size of every sample')
+
+    parser.add_argument('-x', '--extract', type=str, metavar='DIR',
+                    help='extract the samples into DIR')
+
+    parser.add_argument('-n', '--numbers', type=int, nargs='+',
+                    help='only extract the samples with these numbers')
+
+    parser.add_argument('-s', '--seed', type=lambda value: int(value, 0),
+                    help='write the sample with this seed to stdout')
+
+    parser.add_argument('-e', '--extension', type=str, default='.html',
+                    help='extension of the extracted files (default .html)')
+    return parser
+
+
+def main():
+
+    parser = get_argument_parser()
+
+    args = parser.parse_args()
+
+    try:
+        reader = CorpusReader(args.archive)
+    except (IOError, CorpusError) as e:
+        print('Error reading ' + args.archive + ': ' + str(e))
+        return 1
+
+    with reader:
+        if args.list:
+            for number in range(len(reader)):
+                seed, compression, size = reader.get_info(number)
+                print('%d %d %s %d' % (number, seed, compression or 'none',
+                                       size))
+        elif args.extract:
+            outfiles = reader.extract(args.extract, args.numbers,
+                                      args.extension)
+            print('Extracted ' + str(len(outfiles)) + ' samples')
+        elif args.seed is not None:
+            try:
+                number = reader.find_seed(args.seed)
+            except KeyError:
+                print('No sample with seed ' + str(args.seed))
+                return 1
+            out = getattr(sys.stdout, 'buffer', sys.stdout)
+            out.write(reader.get(number))
+        else:
+            print(str(len(reader)) + ' samples')
+    return 0
+
+
+if __name__ == '__main__':
+
+    sys.exit(main())
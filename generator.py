@@ -18,88 +18,147 @@
 
 
 from __future__ import print_function
+import gc
+import hashlib
+import io
+import math
+import multiprocessing
 import os
-import re
 import random
+import re
+import struct
 import argparse
 from pathlib import Path
 
-from grammar import Grammar
+from corpus import CorpusError, CorpusWriter
+from grammar import Grammar, Profiler, RandomPool, SampleWriter, Template
 from svg_tags import _SVG_TYPES
 from html_tags import _HTML_TYPES
 from mathml_tags import _MATHML_TYPES
 
+# Line budgets of <jsfuzzer> placeholders that don't specify their own.
 _N_MAIN_LINES = 1000
 _N_EVENTHANDLER_LINES = 500
 
 _N_ADDITIONAL_HTMLVARS = 5
 
+# Number of symbols and creators listed in the profile.
+_N_PROFILE_ROWS = 30
+
+_HTML_TAGS = list(_HTML_TYPES)
+
+# Written into every sample, see --regenerate.
+_SEED_HEADER = '<!-- domato seed: %d -->\n'
+
+# Lines at the start of a template that stay in front of the seed header:
+# the doctype and comments such as the mark of the web, which browsers
+# only recognize at the very start of a document.
+_LEADING_LINES_PATTERN = re.compile(
+    r'(?:[ \t]*(?:<!doctype[^>]*>|<!--.*?-->)[ \t]*(?:\r?\n|$))*',
+    re.IGNORECASE | re.DOTALL)
+
+# A map from tag name to (variable prefix, type) for all the element types.
+# HTML types take precedence over SVG types, which take precedence over
+# MathML types.
+_TAG_TYPES = {}
+for _types, _prefix in ((_MATHML_TYPES, 'mathmlvar'), (_SVG_TYPES, 'svgvar'),
+                        (_HTML_TYPES, 'htmlvar')):
+    for _tag, _tagtype in _types.items():
+        _TAG_TYPES[_tag] = (_prefix, _tagtype)
+
 def generate_html_elements(ctx, n):
     for i in range(n):
-        tag = random.choice(list(_HTML_TYPES))
+        tag = random.choice(_HTML_TAGS)
         tagtype = _HTML_TYPES[tag]
         ctx['htmlvarctr'] += 1
         varname = 'htmlvar%05d' % ctx['htmlvarctr']
         ctx['htmlvars'].append({'name': varname, 'type': tagtype})
-        ctx['htmlvargen'] += '/* newvar{' + varname + ':' + tagtype + '} */ var ' + varname + ' = document.createElement(\"' + tag + '\"); //' + tagtype + '\n'
+        ctx['htmlvargen'].append('/* newvar{' + varname + ':' + tagtype + '} */ var ' + varname + ' = document.createElement(\"' + tag + '\"); //' + tagtype + '\n')
 
 
-def add_html_ids(matchobj, ctx):
-    tagname = matchobj.group(0)[1:-1]
-    if tagname in _HTML_TYPES:
-        ctx['htmlvarctr'] += 1
-        varname = 'htmlvar%05d' % ctx['htmlvarctr']
-        ctx['htmlvars'].append({'name': varname, 'type': _HTML_TYPES[tagname]})
-        ctx['htmlvargen'] += '/* newvar{' + varname + ':' + _HTML_TYPES[tagname] + '} */ var ' + varname + ' = document.getElementById(\"' + varname + '\"); //' + _HTML_TYPES[tagname] + '\n'
-        return matchobj.group(0) + 'id=\"' + varname + '\" '
-    elif tagname in _SVG_TYPES:
-        ctx['svgvarctr'] += 1
-        varname = 'svgvar%05d' % ctx['svgvarctr']
-        ctx['htmlvars'].append({'name': varname, 'type': _SVG_TYPES[tagname]})
-        ctx['htmlvargen'] += '/* newvar{' + varname + ':' + _SVG_TYPES[tagname] + '} */ var ' + varname + ' = document.getElementById(\"' + varname + '\"); //' + _SVG_TYPES[tagname] + '\n'
-        return matchobj.group(0) + 'id=\"' + varname + '\" '
-    elif tagname in _MATHML_TYPES:
-        ctx['mathmlvarctr'] += 1
-        varname = 'mathmlvar%05d' % ctx['mathmlvarctr']
-        ctx['htmlvars'].append({'name': varname, 'type': _MATHML_TYPES[tagname]})
-        ctx['htmlvargen'] += '/* newvar{' + varname + ':' + _MATHML_TYPES[tagname] + '} */ var ' + varname + ' = document.getElementById(\"' + varname + '\"); //' + _MATHML_TYPES[tagname] + '\n'
-        return matchobj.group(0) + 'id=\"' + varname + '\" '
-    else:
-        return matchobj.group(0)
+def add_html_id(tagname, ctx):
+    """Declares a variable for an element of the HTML being generated.
 
-
-def generate_function_body(jsgrammar, htmlctx, num_lines):
+    Used as the tag hook of the HTML grammar.
+    Returns:
+      The id attribute to add to the element, None for unknown tags.
+    """
+    if tagname not in _TAG_TYPES:
+        return None
+    prefix, tagtype = _TAG_TYPES[tagname]
+    ctx[prefix + 'ctr'] += 1
+    varname = prefix + '%05d' % ctx[prefix + 'ctr']
+    ctx['htmlvars'].append({'name': varname, 'type': tagtype})
+    ctx['htmlvargen'].append('/* newvar{' + varname + ':' + tagtype + '} */ var ' + varname + ' = document.getElementById(\"' + varname + '\"); //' + tagtype + '\n')
+    return 'id=\"' + varname + '\" '
+
+
+def generate_function_body(jsgrammar, htmlctx, num_lines, sink=None,
+                           max_bytes=None):
     js = ''
     js += 'var fuzzervars = {};\n\n'
     js += "SetVariable(fuzzervars, window, 'Window');\nSetVariable(fuzzervars, document, 'Document');\nSetVariable(fuzzervars, document.body.firstChild, 'Element');\n\n"
     js += '//beginjs\n'
     js += htmlctx['htmlvargen']
-    js += jsgrammar._generate_code(num_lines, htmlctx['htmlvars'])
-    js += '\n//endjs\n'
-    js += 'var fuzzervars = {};\nfreememory()\n'
-    return js
+    end = '\n//endjs\n'
+    end += 'var fuzzervars = {};\nfreememory()\n'
+    if max_bytes is not None:
+        # The budget covers the whole content of the placeholder.
+        max_bytes = max(0, max_bytes - len(js) - len(end))
+    if sink is None:
+        return js + jsgrammar._generate_code(num_lines, htmlctx['htmlvars'],
+                                             max_bytes=max_bytes) + end
+    sink.write(js)
+    jsgrammar._generate_code(num_lines, htmlctx['htmlvars'], sink=sink,
+                             max_bytes=max_bytes)
+    sink.write(end)
 
 
 def check_grammar(grammar):
-    """Checks if grammar has errors and if so outputs them.
+    """Checks if grammar imports unknown grammars and if so outputs them.
+
+    The grammar already warns about the other problems when it gets parsed,
+    imports can only be checked after add_import().
     Args:
       grammar: The grammar to check.
+    Returns:
+      The number of problems found.
     """
 
-    for rule in grammar._all_rules:
-        for part in rule['parts']:
-            if part['type'] == 'text':
-                continue
-            tagname = part['tagname']
-            # print tagname
-            if tagname not in grammar._creators:
-                print('No creators for type ' + tagname)
+    problems = grammar.validate(['import'])
+    for problem in problems:
+        print('Warning: ' + problem)
+    return len(problems)
+
+
+def get_byte_budget(attributes):
+    """Returns the byte budget set on a placeholder, e.g. bytes=100000."""
+    if 'bytes' not in attributes:
+        return None
+    return int(attributes['bytes'])
+
+
+def has_byte_budgets(template):
+    """Returns whether a placeholder of a parsed template has a byte budget."""
+    return any(name is not None and 'bytes' in attributes
+               for name, attributes in template.segments)
+
+
+def parse_template(template):
+    """Parses a template string, see grammar.Template.parse.
+
+    Every placeholder can also limit the size of its content in bytes,
+    e.g. <htmlfuzzer bytes=100000>.
+    """
+    return Template.parse(template,
+                          ['cssfuzzer', 'htmlfuzzer', 'jsfuzzer'],
+                          'jsfuzzer', _N_MAIN_LINES, _N_EVENTHANDLER_LINES)
 
 
 def generate_new_sample(template, htmlgrammar, cssgrammar, jsgrammar):
     """Parses grammar rules from string.
     Args:
-      template: A template string.
+      template: A Template returned by parse_template.
       htmlgrammar: Grammar for generating HTML code.
       cssgrammar: Grammar for generating CSS code.
       jsgrammar: Grammar for generating JS code.
@@ -107,87 +166,413 @@ def generate_new_sample(template, htmlgrammar, cssgrammar, jsgrammar):
       A string containing sample data.
     """
 
-    result = template
+    result = io.StringIO()
+    write_new_sample(template, htmlgrammar, cssgrammar, jsgrammar, result)
+    return result.getvalue()
+
+
+def write_new_sample(template, htmlgrammar, cssgrammar, jsgrammar, sink):
+    """Generates a sample and writes it to a sink.
+
+    The template is filled segment by segment. Only the CSS and HTML
+    fragments are kept in memory, the JS function bodies are written to
+    the sink while they are being generated.
+    Args:
+      template: A Template returned by parse_template.
+      htmlgrammar: Grammar for generating HTML code.
+      cssgrammar: Grammar for generating CSS code.
+      jsgrammar: Grammar for generating JS code.
+      sink: A file-like object to write the sample to, e.g. a SampleWriter.
+    """
 
-    css = cssgrammar.generate_symbol('rules')
-    html = htmlgrammar.generate_symbol('bodyelements')
+    css = cssgrammar.generate_symbol(
+        'rules',
+        max_bytes=get_byte_budget(template.get_attributes('cssfuzzer')))
 
     htmlctx = {
         'htmlvars': [],
         'htmlvarctr': 0,
         'svgvarctr': 0,
         'mathmlvarctr': 0,
-        'htmlvargen': ''
+        'htmlvargen': []
     }
-    html = re.sub(
-        r'<[a-zA-Z0-9_-]+ ',
-        lambda match: add_html_ids(match, htmlctx),
-        html
-    )
+    # Elements get their ids and variables while the HTML is generated.
+    htmlgrammar.set_tag_hook(lambda tagname: add_html_id(tagname, htmlctx))
+    try:
+        html = htmlgrammar.generate_symbol(
+            'bodyelements',
+            max_bytes=get_byte_budget(template.get_attributes('htmlfuzzer')))
+    finally:
+        htmlgrammar.set_tag_hook(None)
     generate_html_elements(htmlctx, _N_ADDITIONAL_HTMLVARS)
-
-    result = result.replace('<cssfuzzer>', css)
-    result = result.replace('<htmlfuzzer>', html)
-
-    handlers = False
-    while '<jsfuzzer>' in result:
-        numlines = _N_MAIN_LINES
-        if handlers:
-            numlines = _N_EVENTHANDLER_LINES
-        else:
-            handlers = True
-        result = result.replace(
-            '<jsfuzzer>',
-            generate_function_body(jsgrammar, htmlctx, numlines),
-            1
-        )
-
-    return result
-
-def generate_samples(template, outfiles):
-    """Generates a set of samples and writes them to the output files.
+    htmlctx['htmlvargen'] = ''.join(htmlctx['htmlvargen'])
+
+    template.fill({
+        'cssfuzzer': lambda attributes, sink: css,
+        'htmlfuzzer': lambda attributes, sink: html,
+        'jsfuzzer': lambda attributes, sink: generate_function_body(
+            jsgrammar, htmlctx, int(attributes['lines']), sink,
+            get_byte_budget(attributes))
+    }, sink)
+
+def load_grammars(cache_dir=None, random_pool=False, engine='recursive',
+                  eager=False):
+    """Parses the HTML, CSS and JS grammars.
     Args:
-      grammar_dir: directory to load grammar files from.
-      outfiles: A list of output filenames.
+      cache_dir: Optional directory for caching parsed grammars.
+      random_pool: Whether to draw values of built-in types from a
+        RandomPool instead of the random module.
+      engine: The expansion engine, 'recursive' or 'stack'.
+      eager: Whether to compile all the rules right away.
+    Returns:
+      A (htmlgrammar, cssgrammar, jsgrammar, pool) tuple, where pool is the
+      RandomPool or None, or None if there were errors.
     """
 
     grammar_dir = os.path.join(os.path.dirname(__file__), 'rules')
     htmlgrammar = Grammar()
 
-    err = htmlgrammar.parse_from_file(os.path.join(grammar_dir, 'html.txt'))
-    # CheckGrammar(htmlgrammar)
+    err = htmlgrammar.parse_from_file(os.path.join(grammar_dir, 'html.txt'),
+                                      cache_dir=cache_dir)
     if err > 0:
         print('There were errors parsing html grammar')
-        return
+        return None
 
     cssgrammar = Grammar()
-    err = cssgrammar.parse_from_file(os.path.join(grammar_dir ,'css.txt'))
-    # CheckGrammar(cssgrammar)
+    err = cssgrammar.parse_from_file(os.path.join(grammar_dir ,'css.txt'),
+                                     cache_dir=cache_dir)
     if err > 0:
         print('There were errors parsing css grammar')
-        return
+        return None
 
     jsgrammar = Grammar()
-    err = jsgrammar.parse_from_file(os.path.join(grammar_dir,'js.txt'))
-    # CheckGrammar(jsgrammar)
+    err = jsgrammar.parse_from_file(os.path.join(grammar_dir,'js.txt'),
+                                    cache_dir=cache_dir)
     if err > 0:
         print('There were errors parsing js grammar')
-        return
+        return None
 
     # JS and HTML grammar need access to CSS grammar.
     # Add it as import
     htmlgrammar.add_import('cssgrammar', cssgrammar)
     jsgrammar.add_import('cssgrammar', cssgrammar)
 
-    for outfile in outfiles:
-        result = generate_new_sample(template, htmlgrammar, cssgrammar, jsgrammar)
-        if result is not None:
-            print('Writing a sample to ' + outfile)
-            try:
-                with open(outfile, 'w') as f:
-                    f.write(result)
-            except IOError:
-                print('Error writing to output')
+    check_grammar(htmlgrammar)
+    check_grammar(cssgrammar)
+    check_grammar(jsgrammar)
+
+    # Elements get their ids through a tag hook, see write_new_sample. The
+    # hook points change the rules, so they are added before compiling.
+    htmlgrammar.add_tag_hook_points()
+
+    htmlgrammar.compile_rules(eager)
+    cssgrammar.compile_rules(eager)
+    jsgrammar.compile_rules(eager)
+
+    htmlgrammar.set_engine(engine)
+    cssgrammar.set_engine(engine)
+    jsgrammar.set_engine(engine)
+
+    pool = None
+    if random_pool:
+        pool = RandomPool()
+        htmlgrammar.set_random_pool(pool)
+        cssgrammar.set_random_pool(pool)
+        jsgrammar.set_random_pool(pool)
+
+    return htmlgrammar, cssgrammar, jsgrammar, pool
+
+
+def get_sample_seed(run_seed, index):
+    """Derives the 64-bit seed of a sample from the seed of the run.
+
+    Every sample gets its own random stream, so the samples don't depend on
+    the order in which they are generated, and a sample can be regenerated
+    from its seed alone.
+    """
+    digest = hashlib.sha256(struct.pack('<QQ', run_seed, index)).digest()
+    return struct.unpack('<Q', digest[:8])[0]
+
+
+def get_cpu_count():
+    """Returns the number of CPUs available to this process.
+
+    Takes the CPU affinity and the cgroup (v2 or v1) CPU quota into account,
+    so that containers limited to a few CPUs of a large host don't get
+    oversubscribed.
+    """
+    try:
+        count = len(os.sched_getaffinity(0))
+    except AttributeError:
+        count = os.cpu_count() or 1
+
+    quota = None
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            limit, period = f.read().split()
+        if limit != 'max':
+            quota = float(limit) / float(period)
+    except (IOError, ValueError):
+        try:
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+                limit = int(f.read())
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+                period = int(f.read())
+            if limit > 0 and period > 0:
+                quota = float(limit) / period
+        except (IOError, ValueError):
+            pass
+
+    if quota is not None:
+        count = min(count, max(1, int(math.ceil(quota))))
+    return count
+
+
+def _seed_sample(state, seed):
+    """Seeds the random module and the pool of a state for a sample."""
+    template, htmlgrammar, cssgrammar, jsgrammar, pool = state
+    random.seed(seed)
+    if pool is not None:
+        pool.seed(seed)
+
+
+def _add_seed_header(template, seed):
+    """Returns a copy of a template with the seed header of a sample."""
+    return template.with_text(_SEED_HEADER % seed, _LEADING_LINES_PATTERN)
+
+
+def _retries_avoided(state):
+    """Returns the number of recursion retries the grammars avoided so far."""
+    template, htmlgrammar, cssgrammar, jsgrammar, pool = state
+    return sum(g.get_retries_avoided()
+               for g in (htmlgrammar, cssgrammar, jsgrammar))
+
+
+def write_sample_file(state, outfile, seed):
+    """Generates a sample from the given seed and writes it to a file.
+    Args:
+      state: A (template, htmlgrammar, cssgrammar, jsgrammar, pool) tuple.
+      outfile: The output filename.
+      seed: The seed of the sample.
+    Returns:
+      The number of recursion retries avoided while generating the sample.
+    """
+    template, htmlgrammar, cssgrammar, jsgrammar, pool = state
+    retries_avoided = _retries_avoided(state)
+    _seed_sample(state, seed)
+
+    print('Writing a sample to ' + outfile)
+    try:
+        with SampleWriter(outfile) as writer:
+            write_new_sample(_add_seed_header(template, seed), htmlgrammar,
+                             cssgrammar, jsgrammar, writer)
+    except IOError:
+        print('Error writing to output')
+
+    return _retries_avoided(state) - retries_avoided
+
+
+def generate_sample_data(state, seed):
+    """Generates a sample from the given seed as bytes.
+
+    The bytes are the same as the content of the file written by
+    write_sample_file.
+    Args:
+      state: A (template, htmlgrammar, cssgrammar, jsgrammar, pool) tuple.
+      seed: The seed of the sample.
+    Returns:
+      A (data, retries_avoided) tuple with the UTF-8 encoded sample and the
+      number of recursion retries avoided while generating it.
+    """
+    template, htmlgrammar, cssgrammar, jsgrammar, pool = state
+    retries_avoided = _retries_avoided(state)
+    _seed_sample(state, seed)
+
+    sink = io.StringIO()
+    write_new_sample(_add_seed_header(template, seed), htmlgrammar,
+                     cssgrammar, jsgrammar, sink)
+    data = sink.getvalue().encode('utf-8', 'surrogatepass')
+
+    return data, _retries_avoided(state) - retries_avoided
+
+
+def _parse_seed(value):
+    """Parses a 64-bit seed given in decimal or hexadecimal (0x...)."""
+    seed = int(value, 0)
+    if not 0 <= seed < 2 ** 64:
+        raise argparse.ArgumentTypeError('seed must be a 64-bit unsigned integer')
+    return seed
+
+
+# State and task inherited by the forked worker processes, see
+# _run_samples.
+_worker_state = None
+_worker_task = None
+
+
+def _run_worker_task(args):
+    return _worker_task(_worker_state, *args)
+
+
+def _write_file_task(state, outfile, seed):
+    return write_sample_file(state, outfile, seed), None
+
+
+def _generate_data_task(state, number, seed):
+    data, retries_avoided = generate_sample_data(state, seed)
+    return retries_avoided, (seed, data)
+
+
+def _run_samples(template, targets, task, cache_dir, random_pool, engine,
+                 jobs, seed, profile, first_index=0):
+    """Generates a sample for every target.
+
+    Loads the grammars and calls task(state, target, sample_seed) for every
+    target, in worker processes if jobs > 1. The task returns a
+    (retries_avoided, result) tuple. The seed of a sample is derived from
+    the run seed and the index of its target plus first_index.
+
+    Yields:
+      The results of the tasks, in the order of the targets.
+    """
+    global _worker_state, _worker_task
+
+    if profile:
+        if engine != 'recursive':
+            print('Profiling is only supported with the recursive engine')
+            return
+        jobs = 1
+    if jobs == 0:
+        jobs = get_cpu_count()
+    jobs = min(jobs, len(targets))
+    if jobs > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+        print('Parallel generation is not supported on this platform')
+        jobs = 1
+
+    template = parse_template(template)
+    if engine != 'recursive' and has_byte_budgets(template):
+        print('Byte budgets are only supported with the recursive engine')
+        return
+
+    grammars = load_grammars(cache_dir, random_pool, engine, eager=jobs > 1)
+    if grammars is None:
+        return
+    state = (template,) + grammars
+
+    profiler = None
+    if profile:
+        profiler = Profiler()
+        for grammar in grammars[:3]:
+            grammar.set_profiler(profiler)
+
+    if seed is None:
+        seed = random.SystemRandom().getrandbits(64)
+    print('Run seed: ' + str(seed))
+    tasks = [(target, get_sample_seed(seed, first_index + i))
+             for i, target in enumerate(targets)]
+
+    retries_avoided = 0
+    if jobs <= 1:
+        for target, sample_seed in tasks:
+            retries, result = task(state, target, sample_seed)
+            retries_avoided += retries
+            yield result
+    else:
+        # Workers are forked after the grammars are loaded. Freezing the
+        # garbage collector keeps it from touching (and thus copying) the
+        # pages with the grammars in every worker.
+        _worker_state = state
+        _worker_task = task
+        gc.collect()
+        gc.freeze()
+        try:
+            with multiprocessing.get_context('fork').Pool(jobs) as workers:
+                for retries, result in workers.imap(_run_worker_task, tasks):
+                    retries_avoided += retries
+                    yield result
+        finally:
+            gc.unfreeze()
+            _worker_state = None
+            _worker_task = None
+
+    print('Recursion retries avoided: ' + str(retries_avoided))
+
+    if profiler is not None:
+        profiler.write_collapsed_stacks(profile)
+        print(profiler.get_table(limit=_N_PROFILE_ROWS))
+
+
+def generate_samples(template, outfiles, cache_dir=None, random_pool=False,
+                     engine='recursive', jobs=1, seed=None, profile=None):
+    """Generates a set of samples and writes them to the output files.
+    Args:
+      template: A template string.
+      outfiles: A list of output filenames.
+      cache_dir: Optional directory for caching parsed grammars.
+      random_pool: Whether to draw values of built-in types from a
+        RandomPool instead of the random module.
+      engine: The expansion engine, 'recursive' or 'stack'.
+      jobs: Number of worker processes, 0 for one per available CPU.
+      seed: The 64-bit run seed the seeds of the samples are derived from,
+        random if None.
+      profile: Optional file to write the collapsed stacks of a profile of
+        the generation to. The most expensive symbols and creators are
+        also printed.
+    """
+    for _ in _run_samples(template, outfiles, _write_file_task, cache_dir,
+                          random_pool, engine, jobs, seed, profile):
+        pass
+
+
+def generate_archive(template, archive, num_samples, compression=None,
+                     cache_dir=None, random_pool=False, engine='recursive',
+                     jobs=1, seed=None, profile=None):
+    """Generates a set of samples and appends them to a corpus archive.
+
+    Instead of one file per sample, the samples are packed into a single
+    archive, see corpus.py. The samples are stored in the order of their
+    index, whatever the number of jobs. The seed of a sample is derived
+    from its number in the archive, so appending to an archive with the
+    same run seed adds new samples.
+    Args:
+      template: A template string.
+      archive: The archive filename, created if it doesn't exist.
+      num_samples: The number of samples to generate.
+      compression: None, 'gzip' or 'zstd'.
+      The other arguments are the same as for generate_samples.
+    """
+    try:
+        writer = CorpusWriter(archive, compression)
+    except (IOError, CorpusError) as e:
+        print('Error opening ' + archive + ': ' + str(e))
+        return
+    print('Writing samples to ' + archive)
+    with writer:
+        first = len(writer)
+        for sample_seed, data in _run_samples(
+                template, range(first, first + num_samples),
+                _generate_data_task, cache_dir, random_pool, engine, jobs,
+                seed, profile, first):
+            writer.add(data, sample_seed)
+
+
+def regenerate_sample(template, outfile, seed, cache_dir=None,
+                      random_pool=False, engine='recursive'):
+    """Regenerates the sample with the given seed.
+
+    The seed is the one in the seed header of the sample (not the run
+    seed), the output is identical to the original sample as long as the
+    grammars, the template and the generation options are the same.
+    """
+    template = parse_template(template)
+    if engine != 'recursive' and has_byte_budgets(template):
+        print('Byte budgets are only supported with the recursive engine')
+        return
+    grammars = load_grammars(cache_dir, random_pool, engine)
+    if grammars is None:
+        return
+    write_sample_file((template,) + grammars, outfile, seed)
+
 
 def get_argument_parser():
     
@@ -204,6 +589,34 @@ def get_argument_parser():
 
     parser.add_argument('-t', '--template', type=Path, default=(Path(__file__).parent).joinpath('template.html'),
                     help='template file you want to use')
+
+    parser.add_argument('-c', '--cache_dir', type=str,
+                    help='directory for caching parsed grammars between runs')
+
+    parser.add_argument('-r', '--random_pool', action='store_true',
+                    help='draw values of built-in types from pre-drawn blocks of random numbers')
+
+    parser.add_argument('-e', '--engine', choices=['recursive', 'stack'],
+                    default='recursive',
+                    help='expand symbols recursively or on an explicit stack')
+
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                    help='number of worker processes, 0 for one per available CPU')
+
+    parser.add_argument('-s', '--seed', type=_parse_seed,
+                    help='64-bit run seed to derive the seeds of the samples from')
+
+    parser.add_argument('--regenerate', type=_parse_seed, metavar='SEED',
+                    help='regenerate the sample with the given seed (from its header) into --file')
+
+    parser.add_argument('-p', '--profile', type=str, metavar='FILE',
+                    help='profile the generation and write collapsed stacks for flame graphs to FILE')
+
+    parser.add_argument('-a', '--archive', type=str,
+                    help='append the samples to a single corpus archive instead of writing a file per sample (see corpus.py)')
+
+    parser.add_argument('-z', '--compression', choices=['gzip', 'zstd'],
+                    help='compress every sample in the archive')
     return parser
 
 def main():
@@ -215,8 +628,26 @@ def main():
     with args.template.open("r") as f:
         template = f.read()
 
-    if args.file:
-        generate_samples(template, [args.file])
+    if args.regenerate is not None:
+        if not args.file:
+            print("Please use switch -f to specify the output file")
+        else:
+            regenerate_sample(template, args.file, args.regenerate,
+                              args.cache_dir, args.random_pool, args.engine)
+
+    elif args.file:
+        generate_samples(template, [args.file], args.cache_dir,
+                         args.random_pool, args.engine, args.jobs, args.seed,
+                         args.profile)
+
+    elif args.archive:
+        if not args.no_of_files:
+            print("Please use switch -n to specify the number of files")
+        else:
+            generate_archive(template, args.archive, args.no_of_files,
+                             args.compression, args.cache_dir,
+                             args.random_pool, args.engine, args.jobs,
+                             args.seed, args.profile)
 
     elif args.output_dir:
         if not args.no_of_files:
@@ -235,7 +666,9 @@ def main():
             for i in range(nsamples):
                 outfiles.append(os.path.join(out_dir, 'fuzz-' + str(i).zfill(5) + '.html'))
             
-            generate_samples(template, outfiles)
+            generate_samples(template, outfiles, args.cache_dir,
+                             args.random_pool, args.engine, args.jobs,
+                             args.seed, args.profile)
                 
 
     else:
@@ -19,15 +19,26 @@
 
 from __future__ import print_function
 
-import bisect
+import ast
+import hashlib
+import io
 try:
     from html import escape as _escape
 except ImportError:
     from cgi import escape as _escape
+import marshal
+try:
+    import numpy
+except ImportError:
+    numpy = None
 import os
+import pickle
 import random
 import re
 import struct
+import sys
+import tempfile
+import time
 
 _INT_RANGES = {
     'int': [-2147483648, 2147483647],
@@ -53,14 +64,77 @@ _INT_FORMATS = {
     'uint64': 'Q'
 }
 
-_NONINTERESTING_TYPES = [
+# Bump whenever the layout of the parsed grammar changes so that stale
+# cache files get ignored.
+_CACHE_VERSION = 10
+
+# Grammar attributes that are computed by parsing and stored in the cache.
+_CACHED_ATTRIBUTES = [
+    '_root',
+    '_creators',
+    '_nonrecursive_creators',
+    '_all_rules',
+    '_interesting_lines',
+    '_all_nonhelper_lines',
+    '_creator_cdfs',
+    '_nonrecursivecreator_cdfs',
+    '_creator_alias_tables',
+    '_nonrecursivecreator_alias_tables',
+    '_min_depths',
+    '_termination_tables',
+    '_selection_tables',
+    '_inferred_nonrecursive',
+    '_lazy_imports',
+    '_lazy_files',
+    '_lazy_symbols',
+    '_var_format',
+    '_line_guard',
+    '_recursion_max',
+    '_var_reuse_prob',
+    '_inheritance',
+    '_extends_closures',
+    '_problems',
+    '_source_files'
+]
+
+# Name of the Python function defined by the code object of a
+# user-defined function, see Grammar._save_function.
+_USER_FUNCTION_NAME = '_user_function'
+
+# Number of generated lines of code that get written to a sink at once.
+_SINK_BATCH_LINES = 100
+
+# Upper bound on the number of buffers passed to a single os.writev call
+# (IOV_MAX is 1024 on Linux and macOS).
+_MAX_WRITEV_BUFFERS = 1024
+
+# Fraction of a byte budget after which expansions are restricted to
+# nonrecursive creators. Once the budget is used up completely, only the
+# creators with the smallest expansion depth are used.
+_BUDGET_SOFT_LIMIT = 0.9
+
+# Number of randomly picked lines of code in a row that have to exceed a
+# byte budget before the generation of code stops.
+_BUDGET_LINE_ATTEMPTS = 20
+
+_NONINTERESTING_TYPES = frozenset([
     'short',
     'long',
     'DOMString',
     'boolean',
     'float',
     'double'
-]
+])
+
+
+# Parsed grammar files shared by all the grammars of the process, see
+# Grammar._include_cached.
+_fragment_cache = {}
+
+
+def clear_fragment_cache():
+    """Frees the parsed grammar files kept for reuse by later grammars."""
+    _fragment_cache.clear()
 
 
 class Error(Exception):
@@ -77,6 +151,1019 @@ class RecursionError(Error):
     pass
 
 
+class RandomPool(object):
+    """Serves random values for built-in types from pre-drawn blocks.
+
+    Drawing random numbers one by one from the random module costs a
+    Python-level call (or several, for randint) per value. The pool draws
+    large blocks of uniform floats, 64-bit integers and bytes at once,
+    using NumPy if it is available, and hands them out from there.
+    Strings with characters in the 0-255 range are produced from the byte
+    block with a single translate() call.
+
+    The pool is seedable: the same seed gives the same sequence of values
+    (note that NumPy and the random module fallback produce different
+    sequences for the same seed).
+    """
+
+    def __init__(self, seed=None, block_size=65536):
+        self._block_size = block_size
+        self._translation_tables = {}
+        self.seed(seed)
+
+    def seed(self, seed=None):
+        """Reseeds the pool and discards all pre-drawn values."""
+        if numpy is not None:
+            self._generator = numpy.random.default_rng(seed)
+        else:
+            self._generator = random.Random(seed)
+        self._floats = []
+        self._float_pos = 0
+        self._ints = []
+        self._int_pos = 0
+        self._bytes = b''
+        self._byte_pos = 0
+
+    def _draw_floats(self, n):
+        if numpy is not None:
+            return self._generator.random(n).tolist()
+        rand = self._generator.random
+        return [rand() for _ in range(n)]
+
+    def _draw_bytes(self, n):
+        if numpy is not None:
+            return self._generator.bytes(n)
+        return self._generator.getrandbits(8 * n).to_bytes(n, 'little')
+
+    def _draw_ints(self, n):
+        """Draws a block of uniform 64-bit unsigned integers."""
+        return list(struct.unpack('<%dQ' % n, self._draw_bytes(8 * n)))
+
+    def random(self):
+        """Returns a uniform float in [0, 1)."""
+        pos = self._float_pos
+        if pos == len(self._floats):
+            self._floats = self._draw_floats(self._block_size)
+            pos = 0
+        self._float_pos = pos + 1
+        return self._floats[pos]
+
+    def randint(self, a, b):
+        """Returns a uniform integer in [a, b]."""
+        n = b - a + 1
+        if n <= 0x20000000000000:
+            # Exact as long as n fits in the 53-bit float mantissa.
+            return a + int(self.random() * n)
+        if n > 0x10000000000000000:
+            high = self.randint(0, 0xFFFFFFFFFFFFFFFF)
+            low = self.randint(0, 0xFFFFFFFFFFFFFFFF)
+            return a + ((high << 64) | low) % n
+        pos = self._int_pos
+        if pos == len(self._ints):
+            self._ints = self._draw_ints(self._block_size)
+            pos = 0
+        self._int_pos = pos + 1
+        # Slightly biased for ranges that don't divide 2**64, which is
+        # insignificant for the ranges that need more than 53 bits.
+        return a + self._ints[pos] % n
+
+    def _take_bytes(self, n):
+        pos = self._byte_pos
+        if pos + n > len(self._bytes):
+            self._bytes = self._draw_bytes(max(n, self._block_size))
+            pos = 0
+        self._byte_pos = pos + n
+        return self._bytes[pos:pos + n]
+
+    def _get_translation_table(self, min_value, max_value):
+        """Returns a (table, rejected) pair for bytes.translate().
+
+        Each byte is mapped into [min_value, max_value]. Bytes beyond the
+        largest multiple of the range size are rejected (deleted) so that
+        every character is equally likely.
+        """
+        key = (min_value, max_value)
+        if key not in self._translation_tables:
+            n = max_value - min_value + 1
+            accepted = 256 - 256 % n
+            table = bytes(min_value + b % n if b < accepted else 0
+                          for b in range(256))
+            rejected = bytes(range(accepted, 256))
+            self._translation_tables[key] = (table, rejected)
+        return self._translation_tables[key]
+
+    def string(self, min_value, max_value, length):
+        """Returns a string of length characters in [min_value, max_value]."""
+        if max_value > 255:
+            n = max_value - min_value + 1
+            return ''.join([chr(min_value + int(self.random() * n))
+                            for _ in range(length)])
+        table, rejected = self._get_translation_table(min_value, max_value)
+        ret = b''
+        while len(ret) < length:
+            # At least half the bytes are accepted, draw a bit more than
+            # needed so that a single round is almost always enough.
+            needed = length - len(ret)
+            chunk = self._take_bytes(needed + (needed >> 1) + 8)
+            ret += chunk.translate(table, rejected)
+        return ret[:length].decode('latin-1')
+
+
+# Kinds of rule parts. The kind is resolved once while parsing so that
+# expanding a rule doesn't need to inspect the tag attributes again.
+_TEXT = 0        # Constant text, including built-in constants such as <lt>.
+_CONSTANT = 1    # Built-in constant with an id or beforeoutput attribute.
+_NEW_VAR = 2     # <new type> in a code rule.
+_BUILT_IN = 3    # Built-in type such as <int> or <string>.
+_CALL = 4        # <call function=...>
+_ANY = 5         # <any>
+_SYMBOL = 6      # User-defined symbol.
+_TAG = 7         # Hook point after an opening tag, see Grammar.set_tag_hook.
+
+# Opening of an element in constant text, e.g. '<div '.
+_OPEN_TAG_PATTERN = re.compile(r'<([a-zA-Z0-9_-]+) ')
+
+# Grammar rule lines, as recognized by the scan of files included with
+# !lazy_include.
+_RULE_LINE_PATTERN = re.compile(r'^<([^>]*)>\s*=')
+
+# Patterns of the grammar syntax, see _include_from_string.
+_COMMAND_PATTERN = re.compile(r'^!([a-z_]+)\s*(.*)$')
+_FUNCTION_PATTERN = re.compile(r'^function\s*([a-zA-Z._0-9]+)$')
+_GRAMMAR_RULE_PATTERN = re.compile(r'^<([^>]*)>\s*=\s*(.*)$')
+_TAG_PATTERN = re.compile(r'<([^>)]*)>')
+
+
+class SampleWriter(object):
+    """Writes generated text to a file as UTF-8 encoded bytes.
+
+    Can be passed as a sink to Grammar.generate_symbol and
+    Grammar._generate_code. Lone surrogates (which <char> can generate)
+    are encoded with 'surrogatepass' instead of making the write fail.
+    The encoded pieces are buffered and written out in bulk, with
+    os.writev where available.
+
+    Usage example:
+    >>> with SampleWriter('sample.html') as writer:
+    ...     grammar.generate_symbol('foo', writer)
+    """
+
+    def __init__(self, filename, buffer_size=1 << 18):
+        self._file = open(filename, 'wb', buffering=0)
+        self._buffers = []
+        self._size = 0
+        self._buffer_size = buffer_size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, s):
+        data = s.encode('utf-8', 'surrogatepass')
+        self._buffers.append(data)
+        self._size += len(data)
+        if self._size >= self._buffer_size:
+            self.flush()
+
+    def writelines(self, lines):
+        for s in lines:
+            data = s.encode('utf-8', 'surrogatepass')
+            self._buffers.append(data)
+            self._size += len(data)
+        if self._size >= self._buffer_size:
+            self.flush()
+
+    def flush(self):
+        buffers = self._buffers
+        self._buffers = []
+        self._size = 0
+        if not hasattr(os, 'writev'):
+            self._write_all(b''.join(buffers))
+            return
+        fd = self._file.fileno()
+        for i in range(0, len(buffers), _MAX_WRITEV_BUFFERS):
+            batch = buffers[i:i + _MAX_WRITEV_BUFFERS]
+            written = os.writev(fd, batch)
+            # Partial writes are rare, write the rest the slow way.
+            if written < sum(len(data) for data in batch):
+                self._write_all(b''.join(batch)[written:])
+
+    def _write_all(self, data):
+        data = memoryview(data)
+        while data:
+            data = data[self._file.write(data):]
+
+    def close(self):
+        if self._file.closed:
+            return
+        try:
+            self.flush()
+        finally:
+            self._file.close()
+
+
+class Template(object):
+    """A sample template, parsed into text and placeholder segments.
+
+    Placeholders are tags with one of the given names, optionally with
+    attributes, e.g. <jsfuzzer lines=500>. A template is parsed once and
+    then filled for every sample in a single pass over its segments.
+
+    Attributes:
+        segments: A list of (name, value) tuples. For text, name is None
+            and value is the text. For placeholders, value is a dictionary
+            with the attributes of the placeholder.
+
+    Usage example:
+    >>> template = Template('<p><foo count=3></p>', ['foo'])
+    >>> template.fill({'foo': lambda attrs, sink: 'x' * int(attrs['count'])})
+    '<p>xxx</p>'
+    """
+
+    def __init__(self, template, placeholders):
+        pattern = re.compile(
+            '<(' + '|'.join(re.escape(name) for name in placeholders) +
+            r')((?:\s+[\w-]+=[^\s>]*)*)\s*>')
+        self.segments = []
+        position = 0
+        for match in pattern.finditer(template):
+            if match.start() > position:
+                self.segments.append((None, template[position:match.start()]))
+            attributes = {}
+            for name, value in re.findall(r'([\w-]+)=([^\s>]*)',
+                                          match.group(2)):
+                attributes[name] = value.strip('\'"')
+            self.segments.append((match.group(1), attributes))
+            position = match.end()
+        if position < len(template):
+            self.segments.append((None, template[position:]))
+
+    @classmethod
+    def parse(cls, template, placeholders, lines_placeholder, first_lines,
+              lines):
+        """Parses a template whose placeholders get lines of code.
+
+        Each placeholder named lines_placeholder can set its number of
+        lines, e.g. <jsfuzzer lines=500>. Otherwise the first one gets
+        first_lines and the others get lines.
+
+        Args:
+            template: The template string.
+            placeholders: The names of all the placeholders.
+            lines_placeholder: The name of the placeholders with lines.
+            first_lines: Default number of lines of the first one.
+            lines: Default number of lines of the others.
+
+        Returns:
+            A Template.
+        """
+        ret = cls(template, placeholders)
+        ret.set_default(lines_placeholder, 'lines', first_lines, lines)
+        return ret
+
+    def with_text(self, text, skipped=None):
+        """Returns a copy of the template with text added at the start.
+
+        Args:
+            text: The text to add.
+            skipped: Optional compiled regular expression. Text at the
+                start of the template that it matches stays in front of
+                the added text.
+
+        Returns:
+            A Template sharing the placeholder attributes of this one.
+        """
+        ret = Template('', [])
+        ret.segments = list(self.segments)
+        if ret.segments and ret.segments[0][0] is None:
+            start = ret.segments[0][1]
+            match = skipped.match(start) if skipped is not None else None
+            position = match.end() if match else 0
+            ret.segments[0] = (None,
+                               start[:position] + text + start[position:])
+        else:
+            ret.segments.insert(0, (None, text))
+        return ret
+
+    def set_default(self, name, attribute, first_value, value):
+        """Sets an attribute on placeholders that don't specify it.
+
+        The first placeholder with the given name gets first_value, all the
+        following ones get value.
+        """
+        for segment_name, attributes in self.segments:
+            if segment_name != name:
+                continue
+            if attribute not in attributes:
+                attributes[attribute] = str(first_value)
+            first_value = value
+
+    def get_attributes(self, name):
+        """Returns the attributes of the first placeholder with a name.
+
+        Returns:
+            A dictionary of attributes, empty if there is no such
+            placeholder.
+        """
+        for segment_name, attributes in self.segments:
+            if segment_name == name:
+                return attributes
+        return {}
+
+    def fill(self, fillers, sink=None):
+        """Fills the placeholders in order.
+
+        Args:
+            fillers: A dictionary mapping each placeholder name to a function
+                that takes the placeholder attributes and the sink. The
+                function either writes the content of the placeholder to
+                the sink or returns it.
+            sink: A file-like object to write the sample to.
+
+        Returns:
+            The filled template if no sink was given.
+        """
+        if sink is None:
+            sink = io.StringIO()
+            self.fill(fillers, sink)
+            return sink.getvalue()
+        for name, value in self.segments:
+            if name is None:
+                sink.write(value)
+                continue
+            content = fillers[name](value, sink)
+            if content is not None:
+                sink.write(content)
+
+
+# Columns of the statistics kept by the Profiler.
+_PROFILE_COLUMNS = ['count', 'inclusive', 'exclusive', 'bytes',
+                    'recursion_errors']
+
+
+class Profiler(object):
+    """Collects statistics about symbol expansions.
+
+    A profiler is attached to grammars with Grammar.set_profiler(). For
+    every symbol and every creator (rule) of a symbol it then records the
+    number of expansions, the inclusive and exclusive time spent expanding
+    them, the number of bytes they produced and the number of expansions
+    that failed with a RecursionError. Inclusive time and bytes of a
+    recursive symbol only count its outermost expansion.
+
+    Only the recursive engine is instrumented. The generated output is the
+    same with and without a profiler.
+
+    Usage example:
+    >>> profiler = Profiler()
+    >>> grammar.set_profiler(profiler)
+    >>> grammar.generate_symbol('foo')
+    >>> print(profiler.get_table())
+    >>> profiler.write_collapsed_stacks('foo.folded')
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Discards all the collected statistics."""
+        # Maps symbols and (symbol, creator) pairs to lists of values of
+        # _PROFILE_COLUMNS.
+        self._symbols = {}
+        self._creators = {}
+        # Exclusive time for every stack of symbols, ';'-separated.
+        self._stacks = {}
+        # Number of active expansions of each symbol and creator.
+        self._active = {}
+        # [symbol, stack, creator, start time, time spent in children] for
+        # each expansion in progress.
+        self._stack = []
+
+    def enter(self, symbol, creator=None):
+        """Records the start of the expansion of a symbol."""
+        if self._stack:
+            stack = self._stack[-1][1] + ';' + symbol
+        else:
+            stack = symbol
+        self._active[symbol] = self._active.get(symbol, 0) + 1
+        self._stack.append([symbol, stack, None, time.perf_counter(), 0.0])
+        if creator is not None:
+            self.set_creator(creator)
+
+    def set_creator(self, creator):
+        """Records the creator selected for the symbol being expanded."""
+        if not self._stack:
+            return
+        entry = self._stack[-1]
+        entry[2] = creator
+        key = (entry[0], creator)
+        self._active[key] = self._active.get(key, 0) + 1
+
+    def leave(self, num_bytes, recursion_error=False):
+        """Records the end of the innermost expansion in progress."""
+        symbol, stack, creator, start, child_time = self._stack.pop()
+        elapsed = time.perf_counter() - start
+        exclusive = elapsed - child_time
+        if self._stack:
+            self._stack[-1][4] += elapsed
+        self._stacks[stack] = self._stacks.get(stack, 0.0) + exclusive
+        self._add(self._symbols, symbol, elapsed, exclusive, num_bytes,
+                  recursion_error)
+        if creator is not None:
+            self._add(self._creators, (symbol, creator), elapsed, exclusive,
+                      num_bytes, recursion_error)
+
+    def _add(self, table, key, elapsed, exclusive, num_bytes,
+             recursion_error):
+        stats = table.get(key)
+        if stats is None:
+            stats = [0, 0.0, 0.0, 0, 0]
+            table[key] = stats
+        self._active[key] -= 1
+        stats[0] += 1
+        if not self._active[key]:
+            stats[1] += elapsed
+            stats[3] += num_bytes
+        stats[2] += exclusive
+        if recursion_error:
+            stats[4] += 1
+
+    def get_symbol_stats(self):
+        """Returns a dictionary of per-symbol statistics.
+
+        Each value is a dictionary with the keys in _PROFILE_COLUMNS. Times
+        are in seconds.
+        """
+        return dict((symbol, dict(zip(_PROFILE_COLUMNS, stats)))
+                    for symbol, stats in self._symbols.items())
+
+    def get_creator_stats(self):
+        """Returns a dictionary of per-creator statistics.
+
+        Same as get_symbol_stats(), but keyed by (symbol, rule) pairs.
+        """
+        return dict((key, dict(zip(_PROFILE_COLUMNS, stats)))
+                    for key, stats in self._creators.items())
+
+    def get_collapsed_stacks(self):
+        """Returns the exclusive time of every stack of symbols.
+
+        The output is in the collapsed stack format used by flame graph
+        tools: one 'outer;...;inner microseconds' line per stack.
+        """
+        lines = []
+        for stack, elapsed in sorted(self._stacks.items()):
+            microseconds = int(elapsed * 1000000 + 0.5)
+            if microseconds > 0:
+                lines.append(stack + ' ' + str(microseconds))
+        return '\n'.join(lines) + '\n'
+
+    def write_collapsed_stacks(self, filename):
+        """Writes the collapsed stacks to a file."""
+        with open(filename, 'w') as f:
+            f.write(self.get_collapsed_stacks())
+
+    def get_table(self, sort_by='exclusive', limit=None):
+        """Returns the statistics as a text table.
+
+        Args:
+            sort_by: The column to sort by (descending), one of
+                _PROFILE_COLUMNS.
+            limit: Maximum number of symbols and creators to list.
+        """
+        if sort_by not in _PROFILE_COLUMNS:
+            raise ValueError('Unknown column ' + sort_by)
+        column = _PROFILE_COLUMNS.index(sort_by)
+        header = '%10s %12s %12s %12s %10s  ' % (
+            'count', 'incl. (ms)', 'excl. (ms)', 'bytes', 'rec. err.')
+        lines = [header + 'symbol']
+        for symbol, stats in self._sort(self._symbols, column, limit):
+            lines.append(self._format_stats(stats) + symbol)
+        lines.append('')
+        lines.append(header + 'creator')
+        for (symbol, creator), stats in self._sort(self._creators, column,
+                                                   limit):
+            lines.append(self._format_stats(stats) + symbol + ' := ' +
+                         _format_rule(creator))
+        return '\n'.join(lines)
+
+    def _sort(self, table, column, limit):
+        items = sorted(table.items(), key=lambda item: item[1][column],
+                       reverse=True)
+        if limit is not None:
+            items = items[:limit]
+        return items
+
+    def _format_stats(self, stats):
+        return '%10d %12.3f %12.3f %12d %10d  ' % (
+            stats[0], stats[1] * 1000, stats[2] * 1000, stats[3], stats[4])
+
+
+def _format_rule(rule, max_length=80):
+    """Returns a short, readable form of the right-hand side of a rule."""
+    out = []
+    for part in rule.parts:
+        if part.kind == _TEXT:
+            out.append(part.text)
+        elif part.kind == _NEW_VAR:
+            out.append('<new ' + part.tagname + '>')
+        elif part.kind != _TAG:
+            out.append('<' + part.tagname + '>')
+    text = ''.join(out).replace('\r', '\\r').replace('\n', '\\n')
+    if len(text) > max_length:
+        text = text[:max_length - 3] + '...'
+    return text
+
+
+class Rule(object):
+    """A production rule.
+
+    Attributes:
+        type: 'grammar' for ordinary rules, 'code' for lines of code.
+        parts: A tuple of RulePart objects forming the right-hand side.
+        creates: Attributes of the created symbol for grammar rules, list
+            of attributes of all <new> tags for code rules.
+        recursive: Whether a grammar rule references its own symbol.
+        expand: Specialized expansion function created by
+            Grammar.compile_rules() or None if the rule is interpreted.
+    """
+
+    __slots__ = ('type', 'parts', 'creates', 'recursive', 'expand')
+
+    def __init__(self, rule_type, parts, creates, recursive=False):
+        self.type = rule_type
+        self.parts = parts
+        self.creates = creates
+        self.recursive = recursive
+        self.expand = None
+
+    def __getstate__(self):
+        # Compiled expansion functions can't be pickled, they get
+        # recreated by compile_rules() instead.
+        return (self.type, self.parts, self.creates, self.recursive)
+
+    def __setstate__(self, state):
+        self.type, self.parts, self.creates, self.recursive = state
+        self.expand = None
+
+
+class RulePart(object):
+    """A single constant or tag on the right-hand side of a rule.
+
+    Attributes:
+        kind: One of the part kinds defined above.
+        tagname: Name of the tag, None for constant text.
+        text: The text to output for _TEXT and _CONSTANT parts, the tag
+            name for _TAG parts.
+        attributes: The tag attributes as passed to built-in generators
+            and user-defined functions. Only kept for parts that need them.
+        id: Value of the id attribute or None.
+        beforeoutput: Value of the beforeoutput attribute or None.
+        handler: The Grammar method generating a built-in type.
+    """
+
+    __slots__ = ('kind', 'tagname', 'text', 'attributes', 'id',
+                 'beforeoutput', 'handler')
+
+    def __init__(self, kind, tagname=None, text=None, attributes=None,
+                 part_id=None, beforeoutput=None, handler=None):
+        self.kind = kind
+        self.tagname = tagname
+        self.text = text
+        self.attributes = attributes
+        self.id = part_id
+        self.beforeoutput = beforeoutput
+        self.handler = handler
+
+    def __getstate__(self):
+        return (self.kind, self.tagname, self.text, self.attributes, self.id,
+                self.beforeoutput, self.handler)
+
+    def __setstate__(self, state):
+        (self.kind, self.tagname, self.text, self.attributes, self.id,
+         self.beforeoutput, self.handler) = state
+
+
+def _copy_attributes(attributes, copies):
+    """Returns a copy of a tag dictionary, see _merge_fragment.
+
+    Args:
+        attributes: The dictionary or None.
+        copies: Copies made so far by id of the original.
+    """
+    if attributes is None:
+        return None
+    copy = copies.get(id(attributes))
+    if copy is None:
+        copy = dict(attributes)
+        copies[id(attributes)] = copy
+    return copy
+
+
+def _copy_part(part, copies):
+    """Returns a copy of a rule part, see _merge_fragment."""
+    copy = copies.get(id(part))
+    if copy is None:
+        copy = RulePart(part.kind, part.tagname, part.text,
+                        _copy_attributes(part.attributes, copies),
+                        part.id, part.beforeoutput, part.handler)
+        copies[id(part)] = copy
+    return copy
+
+
+def _copy_fragment(fragment):
+    """Returns a copy of a fragment, see Grammar._include_cached.
+
+    The parts of the rules and their attributes are copied. Parts and
+    attributes shared between rules of the fragment are shared between
+    the copies too.
+    """
+    copies = {}
+    ret = []
+    for entry in fragment:
+        if entry[0] == 'rule':
+            rule_type, parts, creates, recursive, helper_lines = entry[1:]
+            parts = tuple(_copy_part(part, copies) for part in parts)
+            if rule_type == 'grammar':
+                creates = _copy_attributes(creates, copies)
+            else:
+                creates = [_copy_attributes(tag, copies) for tag in creates]
+            entry = ('rule', rule_type, parts, creates, recursive,
+                     helper_lines)
+        ret.append(entry)
+    return ret
+
+
+class _Frame(object):
+    """A rule that is being expanded by the stack engine."""
+
+    __slots__ = ('symbol', 'rule', 'index', 'ret_parts', 'variable_ids',
+                 'new_vars', 'ret_vars', 'recursion_depth',
+                 'force_nonrecursive', 'retried')
+
+    def __init__(self, symbol, rule, recursion_depth, force_nonrecursive):
+        self.symbol = symbol
+        self.rule = rule
+        # Index of the part being expanded.
+        self.index = 0
+        self.ret_parts = []
+        self.variable_ids = {}
+        self.new_vars = []
+        self.ret_vars = []
+        self.recursion_depth = recursion_depth
+        self.force_nonrecursive = force_nonrecursive
+        # Whether the current part is being retried with only
+        # nonrecursive rules after a RecursionError.
+        self.retried = False
+
+
+# Factories of compiled expansion functions, keyed by rule shape.
+_expander_factories = {}
+
+
+class _Context(object):
+    """State shared by all the symbols expanded for a sample.
+
+    Attributes:
+        lastvar: Index of last variable created.
+        lines: Generated lines of code (for programming language
+            generation).
+        variables: A dictionary containing the names of all variables
+            created so far, per type.
+        variable_types: The keys of variables, in the same order, for
+            picking a random type.
+        interesting_lines: Indices of the lines that use a type of which
+            a variable exists.
+        interesting_line_set: The elements of interesting_lines.
+        force_var_reuse: Whether the next symbol should reuse a variable.
+        journal: Types of the variables added since begin(), in order.
+        size: Number of bytes generated so far, used for byte budgets.
+        reserved: Number of bytes the symbols that still have to be
+            expanded need at least, used for byte budgets.
+        budget: Maximum number of bytes to generate or None.
+
+    User-defined functions get the context as well and can keep using it
+    as a dictionary, e.g. context['lines'].
+
+    The lines of code are generated one at a time and a line that fails
+    gets undone with rollback(). lines and interesting_lines are only
+    ever appended to, so their lengths are enough to restore them, and
+    the journal records every variable that needs to be removed again.
+    """
+
+    __slots__ = ('lastvar', 'lines', 'variables', 'variable_types',
+                 'interesting_lines', 'interesting_line_set',
+                 'force_var_reuse', 'journal', 'size', 'reserved',
+                 'budget', '_savepoint', '_extra')
+
+    def __init__(self, last_var=0, budget=None):
+        self.lastvar = last_var
+        self.lines = []
+        self.variables = {}
+        self.variable_types = []
+        self.interesting_lines = []
+        self.interesting_line_set = set()
+        self.force_var_reuse = False
+        self.journal = []
+        self.size = 0
+        self.reserved = 0
+        self.budget = budget
+        self._savepoint = None
+        self._extra = {}
+
+    def __getitem__(self, key):
+        if key in _CONTEXT_KEYS:
+            return getattr(self, key)
+        return self._extra[key]
+
+    def __setitem__(self, key, value):
+        if key in _CONTEXT_KEYS:
+            setattr(self, key, value)
+        else:
+            self._extra[key] = value
+
+    def __contains__(self, key):
+        return key in _CONTEXT_KEYS or key in self._extra
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def begin(self):
+        """Marks the state to return to on rollback()."""
+        self._savepoint = (self.lastvar, len(self.lines),
+                           len(self.interesting_lines), self.force_var_reuse)
+        del self.journal[:]
+
+    def rollback(self):
+        """Undoes all the changes made since the last begin()."""
+        lastvar, num_lines, num_interesting, force_var_reuse = self._savepoint
+        del self.lines[num_lines:]
+        self.interesting_line_set.difference_update(
+            self.interesting_lines[num_interesting:])
+        del self.interesting_lines[num_interesting:]
+        variables = self.variables
+        journal = self.journal
+        while journal:
+            var_type = journal.pop()
+            names = variables[var_type]
+            names.pop()
+            if not names:
+                del variables[var_type]
+                # Types lose their last variable in the reverse order of
+                # getting their first one, so this is always the last type.
+                self.variable_types.pop()
+        self.lastvar = lastvar
+        self.force_var_reuse = force_var_reuse
+
+
+_CONTEXT_KEYS = frozenset(['lastvar', 'lines', 'variables',
+                           'interesting_lines', 'force_var_reuse'])
+
+
+def _get_built_in_length(attributes):
+    """Estimates the typical length of the expansion of a built-in type.
+
+    Used for byte budgets. Other built-in types and invalid attributes
+    count as a single byte.
+    """
+    tagname = attributes['tagname']
+    try:
+        if tagname in _INT_RANGES:
+            if 'b' in attributes or 'be' in attributes:
+                return struct.calcsize(_INT_FORMATS[tagname])
+            min_value, max_value = _INT_RANGES[tagname]
+            if 'min' in attributes:
+                min_value = int(attributes['min'], 0)
+            if 'max' in attributes:
+                max_value = int(attributes['max'], 0)
+            return max(len(str(min_value)), len(str(max_value)))
+        elif tagname in ('float', 'double'):
+            if 'b' in attributes:
+                return 4 if tagname == 'float' else 8
+            # str() of a random float has about 17 significant digits.
+            return 18
+        elif tagname in ('string', 'htmlsafestring'):
+            return (int(attributes.get('minlength', '0'), 0) +
+                    int(attributes.get('maxlength', '20'), 0)) // 2
+    except ValueError:
+        pass
+    return 1
+
+
+def _get_length_bucket(length):
+    """Returns the largest length bucket whose limit is at most length.
+
+    Bucket 2 * k has the limit 2 ** k and bucket 2 * k + 1 the limit
+    1.5 * 2 ** k (rounded down), length has to be positive.
+    """
+    k = length.bit_length() - 1
+    if k == 0:
+        return 0
+    return 2 * k + ((length >> (k - 1)) & 1)
+
+
+def _get_length_bucket_limit(bucket):
+    """Returns the largest length that fits into a length bucket."""
+    return ((2 | (bucket & 1)) << (bucket >> 1)) >> 1
+
+
+def _get_strongly_connected_components(graph):
+    """Finds the strongly connected components of a graph.
+
+    Iterative version of Tarjan's algorithm, so deep grammars don't hit the
+    Python recursion limit.
+
+    Args:
+        graph: A dictionary mapping each node to the set of its successors.
+
+    Returns:
+        A dictionary mapping each node to the root node of its component.
+    """
+    index = {}
+    lowlink = {}
+    on_stack = set()
+    stack = []
+    components = {}
+    for root in graph:
+        if root in index:
+            continue
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(graph[root]))]
+        while work:
+            node, successors = work[-1]
+            for successor in successors:
+                if successor not in index:
+                    index[successor] = lowlink[successor] = len(index)
+                    stack.append(successor)
+                    on_stack.add(successor)
+                    work.append((successor, iter(graph[successor])))
+                    break
+                elif successor in on_stack:
+                    lowlink[node] = min(lowlink[node], index[successor])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        components[member] = node
+                        if member == node:
+                            break
+    return components
+
+
+def _get_rule_shape(rule):
+    """Splits a rule into a shape and the operands for that shape.
+
+    Rules with the same sequence of part kinds share the same compiled
+    code, the constant text, symbol names and attributes are passed to
+    the factory as operands.
+
+    Returns:
+        A (shape, operands) tuple. Shape is a tuple of
+        (kind, beforeoutput, alias) tokens where alias is the index of an
+        earlier token with the same id attribute.
+    """
+    shape = []
+    operands = []
+    ids = {}
+    for part in rule.parts:
+        kind = part.kind
+        if kind == _TEXT:
+            # Adjacent constant text is merged.
+            if shape and shape[-1][0] == _TEXT:
+                operands[-1] += part.text
+            else:
+                shape.append((_TEXT, False, None))
+                operands.append(part.text)
+            continue
+        if part.id is not None and part.id in ids:
+            shape.append((None, False, ids[part.id]))
+            operands.append(None)
+            continue
+        if part.id is not None:
+            ids[part.id] = len(shape)
+        if kind == _SYMBOL or kind == _NEW_VAR:
+            operand = part.tagname
+        elif kind == _CONSTANT or kind == _TAG:
+            operand = part.text
+        elif kind == _BUILT_IN:
+            operand = (part.handler, part.attributes)
+        elif kind == _CALL:
+            operand = part.attributes
+        else:
+            operand = None
+        beforeoutput = part.beforeoutput is not None
+        if beforeoutput:
+            operand = (operand, part.beforeoutput, part.attributes)
+        shape.append((kind, beforeoutput, None))
+        operands.append(operand)
+    return (rule.type, tuple(shape)), operands
+
+
+def _compile_rule_shape(shape):
+    """Generates the factory of expansion functions for a rule shape."""
+    rule_type, tokens = shape
+    src = ['def make(operands):']
+    if tokens:
+        src.append('    (%s,) = operands' % ', '.join(
+            'o%d' % i for i in range(len(tokens))))
+    for i, (kind, beforeoutput, alias) in enumerate(tokens):
+        if beforeoutput:
+            src.append('    o%d, f%d, a%d = o%d' % (i, i, i, i))
+        if kind == _BUILT_IN:
+            src.append('    h%d, o%d = o%d' % (i, i, i))
+    src.append('    def expand(grammar, symbol, context, recursion_depth,'
+               ' force_nonrecursive):')
+    body = []
+    kinds = [token[0] for token in tokens]
+    if _SYMBOL in kinds:
+        body.append('generate = grammar._generate')
+        body.append('depth = recursion_depth + 1')
+    if _NEW_VAR in kinds:
+        body.append('new_vars = []')
+        body.append('ret_vars = []')
+    results = []
+    for i, (kind, beforeoutput, alias) in enumerate(tokens):
+        value = 'e%d' % i
+        if kind == _TEXT:
+            results.append('o%d' % i)
+            continue
+        elif alias is not None:
+            # Copy of an earlier part with the same id.
+            results.append('v%d' % alias)
+            continue
+        elif kind == _SYMBOL:
+            body.append('try:')
+            body.append('    v%d = generate(o%d, context, depth,'
+                        ' force_nonrecursive)' % (i, i))
+            body.append('except RecursionError as e:')
+            body.append('    if force_nonrecursive:')
+            body.append('        raise RecursionError(e)')
+            body.append('    v%d = generate(o%d, context, depth, True)'
+                        % (i, i))
+        elif kind == _BUILT_IN:
+            body.append('v%d = h%d(grammar, o%d)' % (i, i, i))
+        elif kind == _NEW_VAR:
+            body.append("context.lastvar += 1")
+            body.append("n%d = grammar._var_format %% context.lastvar" % i)
+            body.append("new_vars.append({'name': n%d, 'type': o%d})"
+                        % (i, i))
+            body.append('if o%d == symbol:' % i)
+            body.append('    ret_vars.append(n%d)' % i)
+            body.append("v%d = '/* newvar{' + n%d + ':' + o%d +"
+                        " '} */ var ' + n%d" % (i, i, i, i))
+        elif kind == _CONSTANT:
+            body.append('v%d = o%d' % (i, i))
+        elif kind == _TAG:
+            body.append('v%d = grammar._expand_tag(o%d)' % (i, i))
+        elif kind == _CALL:
+            body.append("if 'function' not in o%d:" % i)
+            body.append("    raise GrammarError("
+                        "'Call tag without a function attribute')")
+            body.append("v%d = grammar._call_function(o%d['function'], o%d,"
+                        " context, '')" % (i, i, i))
+        else:
+            body.append('v%d = grammar._get_any_var(context)' % i)
+        if beforeoutput:
+            body.append('e%d = grammar._call_function(f%d, a%d, context, v%d)'
+                        % (i, i, i, i))
+        else:
+            value = 'v%d' % i
+        results.append(value)
+    if not results:
+        result = "''"
+    elif len(results) < 4:
+        result = ' + '.join(results)
+    else:
+        result = "''.join((%s))" % ', '.join(results)
+    if rule_type == 'grammar':
+        body.append('return ' + result)
+    else:
+        body.append('return grammar._finish_code_rule(symbol, context, %s,'
+                    ' %s, %s)' % (result,
+                                  'new_vars' if _NEW_VAR in kinds else '()',
+                                  'ret_vars' if _NEW_VAR in kinds else '()'))
+    src.extend('        ' + line for line in body)
+    src.append('    return expand')
+    namespace = {
+        'RecursionError': RecursionError,
+        'GrammarError': GrammarError
+    }
+    # pylint: disable=exec-used
+    exec(compile('\n'.join(src), '<rule shape>', 'exec'), namespace)
+    return namespace['make']
+
+
 class Grammar(object):
     """Parses grammar and generates corresponding languages.
 
@@ -99,14 +1186,89 @@ class Grammar(object):
 
         self._creator_cdfs = {}
         self._nonrecursivecreator_cdfs = {}
+        self._creator_alias_tables = {}
+        self._nonrecursivecreator_alias_tables = {}
+
+        # Interesting lines of each type as a set, see _add_variable.
+        self._interesting_line_sets = {}
+
+        # Minimum expansion depth of every symbol and, per symbol, the
+        # creators that can still terminate within a given depth budget.
+        self._min_depths = {}
+        self._termination_tables = {}
+        # Everything _select_creator needs to know about a symbol, see
+        # _compute_selection_tables.
+        self._selection_tables = {}
+        # Symbols whose nonrecursive creators were inferred, not marked.
+        self._inferred_nonrecursive = set()
+
+        # (kind, name, message) tuples describing the problems found by
+        # _find_problems() when the grammar was loaded.
+        self._problems = []
+
+        # Number of creator selections that had to exclude creators which
+        # would have exceeded the maximum recursion level.
+        self._retries_avoided = 0
 
         self._var_format = 'var%05d'
 
         self._definitions_dir = '.'
+        self._include_level = 0
+
+        # Parsed tags and rule parts, while parsing, see _tokenize_rule.
+        self._tag_cache = {}
+        self._part_cache = {}
 
         self._imports = {}
+        self._imported_files = {}
+
+        # Files imported with !import that haven't been parsed yet, by
+        # import name.
+        self._lazy_imports = {}
+        # Files included with !lazy_include that haven't been parsed yet:
+        # the content and the symbols defined of each file, and the files
+        # defining each symbol.
+        self._lazy_files = {}
+        self._lazy_symbols = {}
+
+        self._compile = False
+        self._stack_engine = False
+
+        # Optional RandomPool serving the built-in types.
+        self._random_pool = None
+
+        # Function called for opening tags, see set_tag_hook().
+        self._tag_hook = None
+        self._tag_hook_points = False
+
+        # Profiler collecting expansion statistics, see set_profiler().
+        self._profiler = None
+
+        # Number of budgeted generate_symbol/_generate_code calls in
+        # progress and the _generate they shadowed.
+        self._budget_level = 0
+        self._unbudgeted_generate = None
+        # The creator with the shortest expansion of every symbol, the
+        # length of that expansion, the length of the shortest expansion
+        # of every creator, per symbol the largest of those lengths and the
+        # tables for selecting the creators that fit into a length (see
+        # _compute_length_tables). Computed when a budget is used for the
+        # first time.
+        self._shortest_creators = None
+        self._shortest_lengths = None
+        self._creator_lengths = None
+        self._max_creator_lengths = None
+        self._length_tables = None
 
         self._functions = {}
+        # Globals shared by the user-defined functions and the functions
+        # created from the code objects in _functions, by name, together
+        # with the code object they were created from.
+        self._function_globals = {}
+        self._function_callables = {}
+
+        # (path, digest) pairs of every file the grammar was parsed from.
+        self._source_files = []
 
         self._line_guard = ''
 
@@ -116,6 +1278,9 @@ class Grammar(object):
         self._max_vars_of_same_type = 5
 
         self._inheritance = {}
+        # Types a new variable gets added as, per type, see
+        # _compute_extends_closures.
+        self._extends_closures = {}
 
         self._cssgrammar = None
 
@@ -154,6 +1319,7 @@ class Grammar(object):
         self._command_handlers = {
             'varformat': self._set_variable_format,
             'include': self._include_from_file,
+            'lazy_include': self._lazy_include_from_file,
             'import': self._import_grammar,
             'lineguard': self._set_line_guard,
             'max_recursion': self._set_recursion_depth,
@@ -180,7 +1346,10 @@ class Grammar(object):
         if min_value > max_value:
             raise GrammarError('Range error in integer tag')
 
-        i = random.randint(min_value, max_value)
+        if self._random_pool is None:
+            i = random.randint(min_value, max_value)
+        else:
+            i = self._random_pool.randint(min_value, max_value)
 
         if 'b' in tag or 'be' in tag:
             if 'be' in tag:
@@ -197,7 +1366,10 @@ class Grammar(object):
         max_value = float(tag.get('max', '1'))
         if min_value > max_value:
             raise GrammarError('Range error in a float tag')
-        f = min_value + random.random() * (max_value - min_value)
+        if self._random_pool is None:
+            f = min_value + random.random() * (max_value - min_value)
+        else:
+            f = min_value + self._random_pool.random() * (max_value - min_value)
         if 'b' in tag:
             if tag['tagname'] == 'float':
                 return struct.pack('f', f)
@@ -215,7 +1387,9 @@ class Grammar(object):
         max_value = self._string_to_int(tag.get('max', '255'))
         if min_value > max_value:
             raise GrammarError('Range error in char tag')
-        return chr(random.randint(min_value, max_value))
+        if self._random_pool is None:
+            return chr(random.randint(min_value, max_value))
+        return chr(self._random_pool.randint(min_value, max_value))
 
     def _generate_string(self, tag):
         """Generates a random string."""
@@ -225,6 +1399,9 @@ class Grammar(object):
             raise GrammarError('Range error in string tag')
         minlen = self._string_to_int(tag.get('minlength', '0'))
         maxlen = self._string_to_int(tag.get('maxlength', '20'))
+        if self._random_pool is not None:
+            length = self._random_pool.randint(minlen, maxlen)
+            return self._random_pool.string(min_value, max_value, length)
         length = random.randint(minlen, maxlen)
         charset = range(min_value, max_value + 1)
         ret_list = [chr(charset[int(random.random() * len(charset))])
@@ -236,7 +1413,10 @@ class Grammar(object):
 
     def _generate_hex(self, tag):
         """Generates a single hex digit."""
-        digit = random.randint(0, 15)
+        if self._random_pool is None:
+            digit = random.randint(0, 15)
+        else:
+            digit = int(self._random_pool.random() * 16)
         if 'up' in tag:
             return '%X' % digit
         else:
@@ -249,7 +1429,9 @@ class Grammar(object):
 
         grammarname = tag['from']
         if grammarname not in self._imports:
-            raise GrammarError('unknown import ' + grammarname)
+            if grammarname not in self._lazy_imports:
+                raise GrammarError('unknown import ' + grammarname)
+            self._load_import(grammarname)
 
         grammar = self._imports[grammarname]
         if 'symbol' in tag:
@@ -266,59 +1448,136 @@ class Grammar(object):
         num_lines = self._string_to_int(tag['count'])
         return self._generate_code(num_lines)
 
-    def _generate_code(self, num_lines, initial_variables=[], last_var=0):
-        """Generates a given number of lines of code."""
+    def _generate_code(self, num_lines, initial_variables=[], last_var=0,
+                       sink=None, max_bytes=None):
+        """Generates a given number of lines of code.
 
-        context = {
-            'lastvar': last_var,
-            'lines': [],
-            'variables': {},
-            'interesting_lines': [],
-            'force_var_reuse': False
-        }
+        If a sink (a file-like object, e.g. a SampleWriter) is given, the
+        lines are written to it in batches while they are being generated
+        and nothing is returned.
+
+        If max_bytes is given, lines that don't fit into the rest of that
+        size (the line guards count as well) are skipped, no new lines are
+        started after _BUDGET_LINE_ATTEMPTS lines in a row didn't fit, and
+        the lines get simpler as they approach it (see generate_symbol).
+        """
+
+        context = _Context(last_var, max_bytes)
 
         for v in initial_variables:
             self._add_variable(v['name'], v['type'], context)
         self._add_variable('document', 'Document', context)
         self._add_variable('window', 'Window', context)
 
-        while len(context['lines']) < num_lines:
-            tmp_context = context.copy()
-            try:
-                if (random.random() < self._interesting_line_prob) and (len(tmp_context['interesting_lines']) > 0):
-                    tmp_context['force_var_reuse'] = True
-                    lineno = random.choice(tmp_context['interesting_lines'])
-                else:
-                    lineno = random.choice(self._all_nonhelper_lines)
-                creator = self._creators['line'][lineno]
-                self._expand_rule('line', creator, tmp_context, 0, False)
-                context = tmp_context
-            except RecursionError as e:
-                print('Warning: ' + str(e))
+        if max_bytes is not None:
+            self._enter_budget()
+            line_overhead = 1
+            if self._line_guard:
+                line_overhead += len(self._line_guard) - len('<line>')
+            num_misses = 0
+        num_written = 0
+        num_bytes = 0
+        try:
+            while num_written + len(context.lines) < num_lines:
+                if max_bytes is not None and num_bytes >= max_bytes:
+                    break
+                if sink is not None and len(context.lines) >= _SINK_BATCH_LINES:
+                    self._write_lines(context.lines, sink, num_written == 0)
+                    num_written += len(context.lines)
+                    del context.lines[:]
+                num_lines_before = len(context.lines)
+                context.begin()
+                try:
+                    if (random.random() < self._interesting_line_prob) and (len(context.interesting_lines) > 0):
+                        context.force_var_reuse = True
+                        lineno = random.choice(context.interesting_lines)
+                    else:
+                        lineno = random.choice(self._all_nonhelper_lines)
+                    creator = self._creators['line'][lineno]
+                    if max_bytes is not None:
+                        context.reserved = self._creator_lengths[creator]
+                        if (context.reserved + line_overhead >
+                                max_bytes - num_bytes):
+                            context.force_var_reuse = False
+                            num_misses += 1
+                            if num_misses >= _BUDGET_LINE_ATTEMPTS:
+                                break
+                            continue
+                        num_misses = 0
+                    self._expand_line(creator, context)
+                except RecursionError as e:
+                    context.rollback()
+                    print('Warning: ' + str(e))
+                if max_bytes is not None:
+                    # Only the lines are output, the symbols expanded for
+                    # them don't add to the size.
+                    for line in context.lines[num_lines_before:]:
+                        num_bytes += len(line) + line_overhead
+                    context.size = num_bytes
+                    context.reserved = 0
+        finally:
+            if max_bytes is not None:
+                self._leave_budget()
+        if sink is not None:
+            if context.lines:
+                self._write_lines(context.lines, sink, num_written == 0)
+            return None
+        return '\n'.join(self._guard_lines(context.lines))
+
+    def _expand_line(self, creator, context):
+        """Expands a creator of the 'line' symbol into the context."""
+        if self._stack_engine:
+            return self._run_stack([_Frame('line', creator, 0, False)],
+                                   context)
+        elif creator.expand is not None or self._compile:
+            expand = creator.expand or self._compile_rule(creator)
+            return expand(self, 'line', context, 0, False)
+        return self._expand_rule('line', creator, context, 0, False)
+
+    def _guard_lines(self, lines):
+        """Wraps the lines of code into the line guard, if any."""
         if not self._line_guard:
-            guarded_lines = context['lines']
-        else:
-            guarded_lines = []
-            for line in context['lines']:
-                guarded_lines.append(self._line_guard.replace('<line>', line))
-        return '\n'.join(guarded_lines)
+            return lines
+        guarded_lines = []
+        for line in lines:
+            guarded_lines.append(self._line_guard.replace('<line>', line))
+        return guarded_lines
+
+    def _write_lines(self, lines, sink, first):
+        """Writes a batch of newline-separated lines of code to a sink."""
+        text = '\n'.join(self._guard_lines(lines))
+        if not first:
+            text = '\n' + text
+        sink.write(text)
+
+    def _create_function(self, function_name):
+        """Creates the Python function of a user-defined function.
+
+        Runs the code object stored by _save_function in the globals shared
+        by all the user-defined functions of the grammar.
 
-    def _exec_function(self, function_name, attributes, context, ret_val):
-        """Executes user-defined python code."""
+        Returns:
+            A (code, function) tuple.
+        """
         if function_name not in self._functions:
             raise GrammarError('Unknown function ' + function_name)
-        compiled_function = self._functions[function_name]
-        args = {
-            'attributes': attributes,
-            'context': context,
-            'ret_val': ret_val
-        }
+        code = self._functions[function_name]
         # pylint: disable=exec-used
+        exec(code, self._function_globals)
+        entry = (code, self._function_globals.pop(_USER_FUNCTION_NAME))
+        self._function_callables[function_name] = entry
+        return entry
+
+    def _call_function(self, function_name, attributes, context, ret_val):
+        """Calls a user-defined function and returns its ret_val."""
+        entry = self._function_callables.get(function_name)
+        # The function gets recreated if it was redefined since.
+        if entry is None or entry[0] is not self._functions[function_name]:
+            entry = self._create_function(function_name)
         try:
-            exec(compiled_function, args)
+            return entry[1](attributes, context, ret_val)
         except Exception as e:
             raise GrammarError('Error in user-defined function: %s' % str(e))
-        return args['ret_val']
 
     def _select_creator(self, symbol, recursion_depth, force_nonrecursive):
         """Selects the creator for the given symbol.
@@ -341,29 +1600,70 @@ class Grammar(object):
         """
 
         # Do we even know how to create this type?
-        if symbol not in self._creators:
-            raise GrammarError('No creators for type ' + symbol)
+        table = self._selection_tables.get(symbol)
+        if table is None:
+            if not self._load_lazy_symbol(symbol):
+                raise GrammarError('No creators for type ' + symbol)
+            table = self._selection_tables[symbol]
 
         if recursion_depth >= self._recursion_max:
             raise RecursionError(
                 'Maximum recursion level reached while creating '
                 'object of type' + symbol
             )
-        elif force_nonrecursive and symbol in self._nonrecursive_creators:
-            creators = self._nonrecursive_creators[symbol]
-            cdf = self._nonrecursivecreator_cdfs[symbol]
+        elif force_nonrecursive and table[3] is not None:
+            creators = table[3]
+            alias_table = table[4]
+        elif recursion_depth + table[0] <= self._recursion_max:
+            creators = table[1]
+            alias_table = table[2]
         else:
-            creators = self._creators[symbol]
-            cdf = self._creator_cdfs[symbol]
-
-        if not cdf:
-            # Uniform distribution, faster
-            return creators[random.randint(0, len(creators) - 1)]
+            creators, alias_table = self._get_terminating_creators(
+                symbol,
+                self._recursion_max - recursion_depth
+            )
 
-        # Select a creator according to the cdf
-        idx = bisect.bisect_left(cdf, random.random(), 0, len(cdf))
+        # A single random number selects a column of the alias table
+        # (integer part) and is compared against the probability of
+        # keeping that column (fractional part).
+        u = random.random() * len(creators)
+        idx = int(u)
+        if alias_table is not None:
+            probabilities, aliases = alias_table
+            if u - idx >= probabilities[idx]:
+                idx = aliases[idx]
         return creators[idx]
 
+    def _get_terminating_creators(self, symbol, max_depth):
+        """Returns the creators of a symbol that terminate within max_depth.
+
+        Returns:
+            A (creators, alias_table) tuple.
+
+        Raises:
+            RecursionError: If none of the creators can terminate in time.
+        """
+        eligible = None
+        for depth, creators, alias_table in self._termination_tables[symbol][1]:
+            if depth > max_depth:
+                break
+            eligible = (creators, alias_table)
+        if eligible is None:
+            raise RecursionError(
+                'Maximum recursion level reached while creating '
+                'object of type' + symbol
+            )
+        self._retries_avoided += 1
+        return eligible
+
+    def get_retries_avoided(self):
+        """Returns how many times a creator selection was restricted.
+
+        Each of these selections would previously have been able to pick a
+        rule that can't be expanded within the maximum recursion level.
+        """
+        return self._retries_avoided
+
     def _generate(self, symbol, context,
                   recursion_depth=0, force_nonrecursive=False):
         """Generates a user-defined symbol.
@@ -373,12 +1673,7 @@ class Grammar(object):
 
         Args:
             symbol: The name of the symbol that is being resolved.
-            context: dictionary consisting of:
-                'lastvar': Index of last variable created.
-                'lines': Generated lines of code
-                    (for programming language generation).
-                'variables': A dictionary containing the names of all
-                    variables created so far.
+            context: The _Context of the sample being generated.
             recursion_depth: Current recursion depth
             force_nonrecursive: Whether to force the use of only
                 non-recursive rules.
@@ -396,18 +1691,18 @@ class Grammar(object):
 
         # print 'Expanding ' + symbol + ' in depth ' + str(recursion_depth)
 
-        force_var_reuse = context['force_var_reuse']
+        force_var_reuse = context.force_var_reuse
 
         # Check if we already have a variable of the given type.
-        if (symbol in context['variables'] and
+        if (symbol in context.variables and
                 symbol not in _NONINTERESTING_TYPES):
-            # print symbol + ':' + str(len(context['variables'][symbol])) + ':' + str(force_var_reuse)
+            # print symbol + ':' + str(len(context.variables[symbol])) + ':' + str(force_var_reuse)
             if (force_var_reuse or
                     random.random() < self._var_reuse_prob or
-                    len(context['variables'][symbol]) > self._max_vars_of_same_type):
+                    len(context.variables[symbol]) > self._max_vars_of_same_type):
                 # print 'reusing existing var of type ' + symbol
-                context['force_var_reuse'] = False
-                variables = context['variables'][symbol]
+                context.force_var_reuse = False
+                variables = context.variables[symbol]
                 return variables[random.randint(0, len(variables) - 1)]
                 # print 'Not reusing existing var of type ' + symbol
 
@@ -416,13 +1711,19 @@ class Grammar(object):
             recursion_depth,
             force_nonrecursive
         )
-        return self._expand_rule(
-            symbol,
-            creator,
-            context,
-            recursion_depth,
-            force_nonrecursive
-        )
+        expand = creator.expand
+        if expand is None:
+            if not self._compile:
+                return self._expand_rule(
+                    symbol,
+                    creator,
+                    context,
+                    recursion_depth,
+                    force_nonrecursive
+                )
+            expand = self._compile_rule(creator)
+        return expand(self, symbol, context, recursion_depth,
+                      force_nonrecursive)
 
     def _expand_rule(self, symbol, rule, context,
                      recursion_depth, force_nonrecursive):
@@ -435,12 +1736,7 @@ class Grammar(object):
         Args:
             symbol: The name of the symbol that is being resolved.
             rule: production rule that will be used to expand the symbol.
-            context: dictionary consisting of:
-                'lastvar': Index of last variable created.
-                'lines': Generated lines of code
-                    (for programming language generation).
-                'variables': A dictionary containing the names of all
-                    variables created so far.
+            context: The _Context of the sample being generated.
             recursion_depth: Current recursion depth
             force_nonrecursive: Whether to force the use of only
                 non-recursive rules.
@@ -459,43 +1755,21 @@ class Grammar(object):
         new_vars = []
         ret_vars = []
         ret_parts = []
-        for part in rule['parts']:
-            if 'id' in part:
-                if part['id'] in variable_ids:
-                    ret_parts.append(variable_ids[part['id']])
+        for part in rule.parts:
+            kind = part.kind
+            if kind == _TEXT:
+                ret_parts.append(part.text)
+                continue
+
+            if part.id is not None:
+                if part.id in variable_ids:
+                    ret_parts.append(variable_ids[part.id])
                     continue
 
-            if part['type'] == 'text':
-                expanded = part['text']
-            elif rule['type'] == 'code' and 'new' in part:
-                var_type = part['tagname']
-                context['lastvar'] += 1
-                var_name = self._var_format % context['lastvar']
-                new_vars.append({'name': var_name, 'type': var_type})
-                # print var_name
-                # print context['lastvar']
-                if var_type == symbol:
-                    ret_vars.append(var_name)
-                expanded = '/* newvar{' + var_name + ':' + var_type + '} */ var ' + var_name
-            elif part['tagname'] in self._constant_types:
-                expanded = self._constant_types[part['tagname']]
-            elif part['tagname'] in self._built_in_types:
-                expanded = self._built_in_types[part['tagname']](part)
-            elif part['tagname'] == 'call':
-                if 'function' not in part:
-                    raise GrammarError('Call tag without a function attribute')
-                expanded = self._exec_function(
-                    part['function'],
-                    part,
-                    context,
-                    ''
-                )
-            elif (part['tagname'] == 'any') and 'variables' in context:
-                expanded = self._get_any_var(context);
-            else:
+            if kind == _SYMBOL:
                 try:
                     expanded = self._generate(
-                        part['tagname'],
+                        part.tagname,
                         context,
                         recursion_depth + 1,
                         force_nonrecursive
@@ -503,72 +1777,637 @@ class Grammar(object):
                 except RecursionError as e:
                     if not force_nonrecursive:
                         expanded = self._generate(
-                            part['tagname'],
+                            part.tagname,
                             context,
                             recursion_depth + 1,
                             True
                         )
                     else:
                         raise RecursionError(e)
+            elif kind == _BUILT_IN:
+                expanded = part.handler(self, part.attributes)
+            else:
+                expanded = self._expand_terminal(symbol, part, context,
+                                                 new_vars, ret_vars)
 
-            if 'id' in part:
-                variable_ids[part['id']] = expanded
+            if part.id is not None:
+                variable_ids[part.id] = expanded
 
-            if 'beforeoutput' in part:
-                expanded = self._exec_function(
-                    part['beforeoutput'],
-                    part,
+            if part.beforeoutput is not None:
+                expanded = self._call_function(
+                    part.beforeoutput,
+                    part.attributes,
                     context,
                     expanded
                 )
 
             ret_parts.append(expanded)
 
+        # Return the result.
+        # In case of 'ordinary' grammar rules, return the filled rule.
+        # In case of code, return just the variable name
+        # and update the context
+        filed_rule = ''.join(ret_parts)
+        if rule.type == 'grammar':
+            return filed_rule
+        else:
+            return self._finish_code_rule(symbol, context, filed_rule,
+                                          new_vars, ret_vars)
+
+    def _expand_terminal(self, symbol, part, context, new_vars, ret_vars):
+        """Expands a part that is not text, a symbol or a built-in type."""
+        kind = part.kind
+        if kind == _NEW_VAR:
+            var_type = part.tagname
+            context.lastvar += 1
+            var_name = self._var_format % context.lastvar
+            new_vars.append({'name': var_name, 'type': var_type})
+            if var_type == symbol:
+                ret_vars.append(var_name)
+            return '/* newvar{' + var_name + ':' + var_type + '} */ var ' + var_name
+        elif kind == _CONSTANT:
+            return part.text
+        elif kind == _TAG:
+            return self._expand_tag(part.text)
+        elif kind == _CALL:
+            if 'function' not in part.attributes:
+                raise GrammarError('Call tag without a function attribute')
+            return self._call_function(
+                part.attributes['function'],
+                part.attributes,
+                context,
+                ''
+            )
+        else:
+            return self._get_any_var(context)
+
+    def _expand_tag(self, tagname):
+        """Calls the tag hook for an opening tag."""
+        if self._tag_hook is None:
+            return ''
+        return self._tag_hook(tagname) or ''
+
+    def set_tag_hook(self, hook):
+        """Sets a function to call for every generated opening tag.
+
+        HTML-like grammars open elements with constant text such as
+        '<lt>div '. When a hook is set for the first time, these openings
+        are located in the rules and hook points are added after them.
+        While a rule gets expanded, the hook is called with the tag name
+        and whatever it returns is inserted right after the opening, e.g.
+        an id attribute for the element.
+
+        Args:
+            hook: A function that takes a tag name and returns a string or
+                None. Passing None removes the hook.
+        """
+        if hook is not None:
+            self.add_tag_hook_points()
+        self._tag_hook = hook
+
+    def add_tag_hook_points(self):
+        """Adds the hook points for set_tag_hook() to the rules.
+
+        set_tag_hook() does this when a hook is set for the first time.
+        Calling it before compile_rules() avoids compiling the changed
+        rules again, e.g. in every worker process sharing the grammar.
+        """
+        if self._tag_hook_points:
+            return
+        for rule in self._all_rules:
+            self._add_tag_hook_points(rule)
+        self._tag_hook_points = True
+
+    def _add_tag_hook_points(self, rule):
+        """Splits constant text of a rule around opening tags."""
+        parts = []
+        text_run = []
+        changed = False
+        for part in rule.parts + (None,):
+            if part is not None and part.kind == _TEXT:
+                text_run.append(part)
+                continue
+            text = ''.join(p.text for p in text_run)
+            position = 0
+            for match in _OPEN_TAG_PATTERN.finditer(text):
+                parts.append(RulePart(_TEXT, text=text[position:match.end()]))
+                parts.append(RulePart(_TAG, text=match.group(1)))
+                position = match.end()
+            if position:
+                changed = True
+                if position < len(text):
+                    parts.append(RulePart(_TEXT, text=text[position:]))
+            else:
+                parts.extend(text_run)
+            text_run = []
+            if part is not None:
+                parts.append(part)
+        if changed:
+            rule.parts = tuple(parts)
+            rule.expand = None
+
+    def _finish_code_rule(self, symbol, context, filed_rule,
+                          new_vars, ret_vars):
+        """Outputs an expanded line of code and adds its new variables."""
         # Add all newly created variables to the context
         additional_lines = []
         for v in new_vars:
             if v['type'] not in _NONINTERESTING_TYPES:
                 self._add_variable(v['name'], v['type'], context)
-                additional_lines.append("if (!" + v['name'] + ") { " + v['name'] + " = GetVariable(fuzzervars, '" + v['type'] + "'); } else { " + self._get_variable_setters(v['name'], v['type']) + " }")
+                additional_lines.append(
+                    self._get_variable_line(v['name'], v['type']))
 
-        # Return the result.
-        # In case of 'ordinary' grammar rules, return the filled rule.
-        # In case of code, return just the variable name
-        # and update the context
-        filed_rule = ''.join(ret_parts)
-        if rule['type'] == 'grammar':
+        context.lines.append(filed_rule)
+        context.lines.extend(additional_lines)
+        if symbol == 'line':
             return filed_rule
         else:
-            context['lines'].append(filed_rule)
-            context['lines'].extend(additional_lines)
-            if symbol == 'line':
-                return filed_rule
+            return ret_vars[random.randint(0, len(ret_vars) - 1)]
+
+    def _push_symbol(self, stack, symbol, context,
+                     recursion_depth, force_nonrecursive):
+        """Starts expanding a symbol on the stack engine.
+
+        Mirrors _generate: the symbol either resolves to an existing
+        variable right away or a frame for the selected creator is pushed.
+
+        Returns:
+            The variable if one was reused, None if a frame was pushed.
+
+        Raises:
+            GrammarError, RecursionError: Same as _select_creator.
+        """
+        force_var_reuse = context.force_var_reuse
+
+        if (symbol in context.variables and
+                symbol not in _NONINTERESTING_TYPES):
+            if (force_var_reuse or
+                    random.random() < self._var_reuse_prob or
+                    len(context.variables[symbol]) > self._max_vars_of_same_type):
+                context.force_var_reuse = False
+                variables = context.variables[symbol]
+                return variables[random.randint(0, len(variables) - 1)]
+
+        creator = self._select_creator(
+            symbol,
+            recursion_depth,
+            force_nonrecursive
+        )
+        stack.append(_Frame(symbol, creator, recursion_depth,
+                            force_nonrecursive))
+        return None
+
+    def _output_part(self, frame, part, expanded, context):
+        """Stores the expansion of a part of the rule of a frame."""
+        if part.id is not None:
+            frame.variable_ids[part.id] = expanded
+        if part.beforeoutput is not None:
+            expanded = self._call_function(
+                part.beforeoutput,
+                part.attributes,
+                context,
+                expanded
+            )
+        frame.ret_parts.append(expanded)
+
+    def _advance_frame(self, stack, frame, context, value):
+        """Expands the parts of the topmost frame on the stack.
+
+        Args:
+            stack: The stack of frames.
+            frame: The topmost frame.
+            context: The generation context.
+            value: Expansion of the symbol the frame was waiting for or
+                None if the frame was just pushed.
+
+        Returns:
+            The expansion of the rule of the frame if it was completed (and
+            popped), None if a frame for a nested symbol was pushed.
+        """
+        parts = frame.rule.parts
+        i = frame.index
+        if value is not None:
+            self._output_part(frame, parts[i], value, context)
+            frame.retried = False
+            i += 1
+
+        for i in range(i, len(parts)):
+            part = parts[i]
+            kind = part.kind
+            if kind == _TEXT:
+                frame.ret_parts.append(part.text)
+                continue
+
+            if part.id is not None:
+                if part.id in frame.variable_ids:
+                    frame.ret_parts.append(frame.variable_ids[part.id])
+                    continue
+
+            if kind == _SYMBOL:
+                frame.index = i
+                try:
+                    expanded = self._push_symbol(
+                        stack,
+                        part.tagname,
+                        context,
+                        frame.recursion_depth + 1,
+                        frame.force_nonrecursive
+                    )
+                except RecursionError as e:
+                    if frame.force_nonrecursive:
+                        raise RecursionError(e)
+                    frame.retried = True
+                    expanded = self._push_symbol(
+                        stack,
+                        part.tagname,
+                        context,
+                        frame.recursion_depth + 1,
+                        True
+                    )
+                if expanded is None:
+                    return None
+                frame.retried = False
+            elif kind == _BUILT_IN:
+                expanded = part.handler(self, part.attributes)
+            else:
+                expanded = self._expand_terminal(frame.symbol, part, context,
+                                                 frame.new_vars,
+                                                 frame.ret_vars)
+
+            self._output_part(frame, part, expanded, context)
+
+        filed_rule = ''.join(frame.ret_parts)
+        if frame.rule.type == 'grammar':
+            stack.pop()
+            return filed_rule
+        filed_rule = self._finish_code_rule(frame.symbol, context, filed_rule,
+                                            frame.new_vars, frame.ret_vars)
+        stack.pop()
+        return filed_rule
+
+    def _unwind_stack(self, stack, context, error):
+        """Handles a RecursionError raised by the topmost frame.
+
+        The failed frame is discarded. Like in _expand_rule, its parent
+        retries the symbol with only nonrecursive rules, unless it is
+        already doing so, in which case the error propagates further.
+
+        Returns:
+            Same as _advance_frame, for the frame that handled the error.
+
+        Raises:
+            RecursionError: If the error propagated past the bottom frame.
+        """
+        while True:
+            stack.pop()
+            if not stack:
+                raise error
+            frame = stack[-1]
+            if frame.retried:
+                continue
+            if frame.force_nonrecursive:
+                error = RecursionError(error)
+                continue
+            frame.retried = True
+            try:
+                return self._push_symbol(
+                    stack,
+                    frame.rule.parts[frame.index].tagname,
+                    context,
+                    frame.recursion_depth + 1,
+                    True
+                )
+            except RecursionError as e:
+                error = e
+
+    def _run_stack(self, stack, context, value=None):
+        """Runs the stack engine until all the frames are expanded.
+
+        Returns:
+            The expansion of the bottom frame.
+        """
+        while stack:
+            try:
+                value = self._advance_frame(stack, stack[-1], context, value)
+            except RecursionError as e:
+                value = self._unwind_stack(stack, context, e)
+        return value
+
+    def _generate_iterative(self, symbol, context,
+                            recursion_depth=0, force_nonrecursive=False):
+        """Same as _generate, but using an explicit stack of frames.
+
+        Nested symbols don't use a Python stack frame, so the recursion
+        depth of the grammar isn't limited by the interpreter's recursion
+        limit. For the same random state, the output is identical to the
+        output of _generate.
+        """
+        stack = []
+        value = self._push_symbol(stack, symbol, context,
+                                  recursion_depth, force_nonrecursive)
+        if value is not None:
+            return value
+        return self._run_stack(stack, context)
+
+    def set_engine(self, engine):
+        """Selects how symbols get expanded.
+
+        Args:
+            engine: 'recursive' (the default) expands nested symbols through
+                recursive calls and can use compiled rules. 'stack'
+                interprets the rules on an explicit stack of frames, which
+                allows a !max_recursion beyond the Python recursion limit.
+                Both engines generate the same output.
+        """
+        if engine not in ('recursive', 'stack'):
+            raise ValueError('Unknown engine ' + engine)
+        self._stack_engine = engine == 'stack'
+        for grammar in self._imported_files.values():
+            grammar.set_engine(engine)
+
+    def set_profiler(self, profiler):
+        """Records statistics about the expansions into a Profiler.
+
+        While a profiler is set, the instrumented versions of _generate,
+        _select_creator and _expand_line shadow the regular methods on
+        the instance, so grammars without a profiler don't pay for the
+        instrumentation. The profiler is also set on the grammars imported
+        with !import. Grammars added with add_import() need to get the same
+        profiler separately.
+
+        Args:
+            profiler: A Profiler object, or None to stop profiling.
+        """
+        self._profiler = profiler
+        if profiler is None:
+            for name in ('_generate', '_select_creator', '_expand_line'):
+                self.__dict__.pop(name, None)
+        else:
+            self._generate = self._profiled_generate
+            self._select_creator = self._profiled_select_creator
+            self._expand_line = self._profiled_expand_line
+        for grammar in self._imported_files.values():
+            grammar.set_profiler(profiler)
+
+    def _profiled_generate(self, symbol, context,
+                           recursion_depth=0, force_nonrecursive=False):
+        return self._profile(symbol, None, Grammar._generate,
+                             (self, symbol, context, recursion_depth,
+                              force_nonrecursive),
+                             context)
+
+    def _profiled_select_creator(self, symbol, recursion_depth,
+                                 force_nonrecursive):
+        creator = Grammar._select_creator(self, symbol, recursion_depth,
+                                          force_nonrecursive)
+        self._profiler.set_creator(creator)
+        return creator
+
+    def _profiled_expand_line(self, creator, context):
+        return self._profile('line', creator, Grammar._expand_line,
+                             (self, creator, context), context)
+
+    def _profile(self, symbol, creator, function, args, context):
+        """Calls an expansion function and records it in the profiler.
+
+        The bytes of an expansion are the bytes of the lines of code it
+        added to the context, or the length of the expansion for symbols
+        that don't generate code.
+        """
+        profiler = self._profiler
+        num_lines = len(context.lines)
+        profiler.enter(symbol, creator)
+        try:
+            result = function(*args)
+        except RecursionError:
+            profiler.leave(0, True)
+            raise
+        except Exception:
+            profiler.leave(0)
+            raise
+        if len(context.lines) > num_lines:
+            num_bytes = sum(len(line) for line in context.lines[num_lines:])
+        else:
+            num_bytes = len(result or '')
+        profiler.leave(num_bytes)
+        return result
+
+    def compile_rules(self, eager=False):
+        """Enables compiling rules into specialized expansion functions.
+
+        Instead of interpreting the parts of a rule on each expansion, the
+        constant text, built-in generators and nested symbols of the rule
+        get baked into a generated Python function. Rules with the same
+        sequence of part kinds share the generated code. Each rule is
+        compiled the first time it is expanded so rules that are never
+        used cost nothing. Compiling doesn't change the generated output.
+
+        Args:
+            eager: Compile all the rules right away, e.g. before forking
+                worker processes so that they share the compiled rules.
+        """
+        self._compile = True
+        if eager:
+            for rule in self._all_rules:
+                if rule.expand is None:
+                    self._compile_rule(rule)
+        for grammar in self._imported_files.values():
+            grammar.compile_rules(eager)
+
+    def _compile_rule(self, rule):
+        """Compiles a single rule and returns its expansion function."""
+        shape, operands = _get_rule_shape(rule)
+        factory = _expander_factories.get(shape)
+        if factory is None:
+            factory = _compile_rule_shape(shape)
+            _expander_factories[shape] = factory
+        rule.expand = factory(operands)
+        return rule.expand
+
+    def _enter_budget(self):
+        """Shadows _generate with _budgeted_generate for a budgeted call.
+
+        Like the profiler, the budget checks only run while there is a
+        budget, the regular expansion doesn't pay for them.
+        """
+        if self._shortest_creators is None:
+            self._compute_shortest_creators()
+        if not self._budget_level:
+            self._unbudgeted_generate = self._generate
+            self._generate = self._budgeted_generate
+        self._budget_level += 1
+
+    def _leave_budget(self):
+        self._budget_level -= 1
+        if not self._budget_level:
+            if self._unbudgeted_generate == self._profiled_generate:
+                self._generate = self._unbudgeted_generate
             else:
-                return ret_vars[random.randint(0, len(ret_vars) - 1)]
+                self.__dict__.pop('_generate', None)
+            self._unbudgeted_generate = None
+
+    def _budgeted_generate(self, symbol, context,
+                           recursion_depth=0, force_nonrecursive=False):
+        """Same as _generate, but keeps to the byte budget of the context.
+
+        context.size counts the bytes of the symbols expanded so far: when
+        an expansion finishes, its length (plus the lines of code it
+        added) replaces the lengths of the nested expansions it contains.
+        context.reserved counts the shortest lengths of the symbols that
+        the rules in progress still have to expand, so that a symbol
+        doesn't use up the part of the budget its siblings need. Creators
+        that can't fit into the rest of the budget are avoided (the others
+        keep their relative probabilities) and close to the budget, only
+        nonrecursive creators are used. Once the budget is used up,
+        existing variables are always reused and other symbols get
+        expanded with their shortest creator.
+        """
+        if context.budget is None:
+            return self._unbudgeted_generate(symbol, context,
+                                             recursion_depth,
+                                             force_nonrecursive)
+        if self._profiler is not None:
+            return self._profile(symbol, None, Grammar._expand_budgeted,
+                                 (self, symbol, context, recursion_depth,
+                                  force_nonrecursive),
+                                 context)
+        return self._expand_budgeted(symbol, context, recursion_depth,
+                                     force_nonrecursive)
+
+    def _expand_budgeted(self, symbol, context, recursion_depth,
+                         force_nonrecursive):
+        """Selects a creator that fits into the budget and expands it."""
+        budget = context.budget
+        size = context.size
+        reserved = context.reserved
+        # The symbol itself was reserved for by the rule it is part of.
+        rest_reserved = reserved - self._shortest_lengths.get(symbol, 1)
+        remaining = budget - size - rest_reserved
+        num_lines = len(context.lines)
+        creator = None
+        if remaining <= 0:
+            if (symbol in context.variables and
+                    symbol not in _NONINTERESTING_TYPES):
+                context.force_var_reuse = False
+                variables = context.variables[symbol]
+                result = variables[random.randint(0, len(variables) - 1)]
+                context.reserved = rest_reserved
+                context.size = size + len(result)
+                return result
+            creator = self._shortest_creators.get(symbol)
+        elif self._max_creator_lengths.get(symbol, 0) > remaining:
+            creator = self._select_short_creator(symbol, remaining,
+                                                 force_nonrecursive)
+        try:
+            if creator is None:
+                if remaining <= budget * (1 - _BUDGET_SOFT_LIMIT):
+                    force_nonrecursive = True
+                if (symbol in context.variables and
+                        symbol not in _NONINTERESTING_TYPES and
+                        (context.force_var_reuse or
+                         random.random() < self._var_reuse_prob or
+                         len(context.variables[symbol]) >
+                         self._max_vars_of_same_type)):
+                    context.force_var_reuse = False
+                    variables = context.variables[symbol]
+                    result = variables[random.randint(0, len(variables) - 1)]
+                    context.reserved = rest_reserved
+                    context.size = size + len(result)
+                    return result
+                creator = self._select_creator(symbol, recursion_depth,
+                                               force_nonrecursive)
+            elif self._profiler is not None:
+                self._profiler.set_creator(creator)
+            context.reserved = rest_reserved + self._creator_lengths[creator]
+            if creator.expand is not None or self._compile:
+                expand = creator.expand or self._compile_rule(creator)
+                result = expand(self, symbol, context, recursion_depth,
+                                force_nonrecursive)
+            else:
+                result = self._expand_rule(symbol, creator, context,
+                                           recursion_depth,
+                                           force_nonrecursive)
+        except RecursionError:
+            # The symbol can get expanded again, e.g. with only
+            # nonrecursive creators.
+            context.size = size
+            context.reserved = reserved
+            raise
+        context.reserved = rest_reserved
+        size += len(result)
+        for line in context.lines[num_lines:]:
+            size += len(line) + 1
+        context.size = size
+        return result
+
+    def _select_short_creator(self, symbol, max_length, force_nonrecursive):
+        """Selects a creator whose shortest expansion fits into max_length.
+
+        Like _select_creator, but from the length tables. If no creator
+        fits, the one with the shortest expansion is returned.
+        """
+        tables, nonrecursive_tables = self._length_tables[symbol]
+        if force_nonrecursive and nonrecursive_tables is not None:
+            tables = nonrecursive_tables
+        table = tables[_get_length_bucket(max_length)]
+        if table is None:
+            return self._shortest_creators[symbol]
+        creators, alias_table = table
+        u = random.random() * len(creators)
+        idx = int(u)
+        if alias_table is not None:
+            probabilities, aliases = alias_table
+            if u - idx >= probabilities[idx]:
+                idx = aliases[idx]
+        return creators[idx]
 
     def generate_root(self):
         """Expands root symbol."""
         if self._root:
-            context = {
-                'lastvar': 0,
-                'lines': [],
-                'variables': {},
-                'force_var_reuse': False
-            }
+            context = _Context()
+            if self._stack_engine:
+                return self._generate_iterative(self._root, context, 0)
             return self._generate(self._root, context, 0)
         else:
             print('Error: No root element defined.')
             return ''
 
-    def generate_symbol(self, name):
-        """Expands a symbol whose name is given as an argument."""
-        context = {
-            'lastvar': 0,
-            'lines': [],
-            'variables': {},
-            'force_var_reuse': False
-        }
-        return self._generate(name, context, 0)
+    def generate_symbol(self, name, sink=None, max_bytes=None):
+        """Expands a symbol whose name is given as an argument.
+
+        If a sink (a file-like object, e.g. a SampleWriter) is given, the
+        expansion is written to it instead of being returned.
+
+        If max_bytes is given, the expansion is steered towards that size.
+        Every symbol only gets the part of the budget that the symbols
+        still to be expanded after it don't need. As the size gets close,
+        recursive rules are avoided and once it is reached, the remaining
+        symbols get expanded with their shortest rules. The size can still
+        be exceeded when max_bytes is smaller than the shortest expansion
+        of the symbol or when built-in types come out longer than usual.
+
+        Raises:
+            GrammarError: If max_bytes is given with the stack engine,
+                which doesn't support budgets.
+        """
+        context = _Context(budget=max_bytes)
+        if self._stack_engine:
+            if max_bytes is not None:
+                raise GrammarError('Byte budgets are only supported by the '
+                                   'recursive engine')
+            result = self._generate_iterative(name, context, 0)
+        elif max_bytes is not None:
+            self._enter_budget()
+            try:
+                context.reserved = self._shortest_lengths.get(name, 1)
+                result = self._generate(name, context, 0)
+            finally:
+                self._leave_budget()
+        else:
+            result = self._generate(name, context, 0)
+        if sink is None:
+            return result
+        sink.write(result)
 
     def _get_cdf(self, symbol, creators):
         """Computes a probability function for a given creator array."""
@@ -583,11 +2422,11 @@ class Grammar(object):
 
         # Get probabilities for individual rule
         for creator in creators:
-            if creator['type'] == 'grammar':
-                create_tag = creator['creates']
+            if creator.type == 'grammar':
+                create_tag = creator.creates
             else:
                 # For type=code multiple variables may be created
-                for tag in creator['creates']:
+                for tag in creator.creates:
                     if tag['tagname'] == symbol:
                         create_tag = tag
                         break
@@ -625,21 +2464,416 @@ class Grammar(object):
 
         return cdf
 
+    def _get_alias_table(self, cdf):
+        """Builds a Walker/Vose alias table from a cdf.
+
+        Returns:
+            A (probabilities, aliases) tuple. Column i of the table is
+            selected with probability probabilities[i], otherwise
+            aliases[i] is used. None for the uniform distribution.
+        """
+        if not cdf:
+            return None
+
+        n = len(cdf)
+        scaled = []
+        previous = 0
+        for p in cdf:
+            scaled.append((p - previous) * n / cdf[-1])
+            previous = p
+
+        probabilities = [1.0] * n
+        aliases = list(range(n))
+        small = [i for i in range(n) if scaled[i] < 1.0]
+        large = [i for i in range(n) if scaled[i] >= 1.0]
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            probabilities[s] = scaled[s]
+            aliases[s] = l
+            scaled[l] = (scaled[l] + scaled[s]) - 1.0
+            if scaled[l] < 1.0:
+                small.append(l)
+            else:
+                large.append(l)
+        # Whatever remains is 1 up to rounding errors.
+        return (probabilities, aliases)
+
     def _normalize_probabilities(self):
         """Preprocessess probabilities for production rules.
 
         Creates CDFs (cumulative distribution functions) and normalizes
         probabilities in the [0,1] range for all creators. This is a
         preprocessing function that makes subsequent creator selection
-        based on probability easier.
+        based on probability easier. From the CDFs, alias tables are
+        built that allow selecting a creator in constant time.
         """
         for symbol, creators in self._creators.items():
             cdf = self._get_cdf(symbol, creators)
             self._creator_cdfs[symbol] = cdf
+            self._creator_alias_tables[symbol] = self._get_alias_table(cdf)
 
         for symbol, creators in self._nonrecursive_creators.items():
             cdf = self._get_cdf(symbol, creators)
             self._nonrecursivecreator_cdfs[symbol] = cdf
+            self._nonrecursivecreator_alias_tables[symbol] = (
+                self._get_alias_table(cdf))
+
+        self._compute_selection_tables()
+
+    def _compute_selection_tables(self):
+        """Gathers the tables used for selecting the creators of a symbol.
+
+        For every symbol, stores a (max_depth, creators, alias_table,
+        nonrecursive_creators, nonrecursive_alias_table) tuple, so that
+        selecting a creator takes a single dictionary lookup instead of one
+        per table. The last two are None for symbols without nonrecursive
+        creators. Needs the termination tables.
+        """
+        self._selection_tables = {}
+        for symbol, creators in self._creators.items():
+            self._selection_tables[symbol] = (
+                self._termination_tables[symbol][0],
+                creators,
+                self._creator_alias_tables[symbol],
+                self._nonrecursive_creators.get(symbol),
+                self._nonrecursivecreator_alias_tables.get(symbol)
+            )
+
+    def _get_symbol_graph(self):
+        """Returns the symbols each creator refers to, per symbol."""
+        graph = {}
+        for symbol, creators in self._creators.items():
+            graph[symbol] = [
+                [part.tagname for part in creator.parts
+                 if part.kind == _SYMBOL]
+                for creator in creators
+            ]
+        return graph
+
+    def _infer_nonrecursive(self, graph):
+        """Marks creators that can't recurse as nonrecursive.
+
+        Only symbols without any creators explicitly marked as nonrecursive
+        are considered. A creator is recursive if any of the symbols it
+        refers to can expand back into the created symbol. Earlier
+        inferences are redone, rules parsed since (see !lazy_include) can
+        make creators recursive.
+        """
+        for symbol in self._inferred_nonrecursive:
+            del self._nonrecursive_creators[symbol]
+        self._inferred_nonrecursive = set()
+
+        edges = {}
+        for symbol, creator_symbols in graph.items():
+            children = set()
+            for symbols in creator_symbols:
+                children.update(s for s in symbols if s in graph)
+            edges[symbol] = children
+        components = _get_strongly_connected_components(edges)
+
+        for symbol, creators in self._creators.items():
+            if symbol in self._nonrecursive_creators:
+                continue
+            component = components[symbol]
+            nonrecursive = [
+                creator
+                for creator, symbols in zip(creators, graph[symbol])
+                if all(components.get(s) != component for s in symbols)
+            ]
+            if nonrecursive and len(nonrecursive) < len(creators):
+                self._nonrecursive_creators[symbol] = nonrecursive
+                self._inferred_nonrecursive.add(symbol)
+
+    def _compute_min_depths(self, graph):
+        """Computes how deep the expansion of every symbol needs to go.
+
+        The minimum depth of a symbol is the smallest number of nested
+        creator selections its expansion requires, 1 for symbols with a
+        creator that doesn't refer to any other symbols. Symbols that can
+        never terminate get an infinite depth. Symbols without creators can
+        only be resolved through existing variables and don't count.
+
+        Returns:
+            A dictionary mapping each creator to its minimum depth.
+        """
+        infinity = float('inf')
+        min_depths = dict((symbol, infinity) for symbol in self._creators)
+        changed = True
+        while changed:
+            changed = False
+            for symbol, creator_symbols in graph.items():
+                depth = min_depths[symbol]
+                for symbols in creator_symbols:
+                    creator_depth = 1
+                    for s in symbols:
+                        child_depth = min_depths.get(s, 0) + 1
+                        if child_depth > creator_depth:
+                            creator_depth = child_depth
+                    if creator_depth < depth:
+                        depth = creator_depth
+                if depth < min_depths[symbol]:
+                    min_depths[symbol] = depth
+                    changed = True
+        self._min_depths = min_depths
+
+        creator_depths = {}
+        for symbol, creators in self._creators.items():
+            for creator, symbols in zip(creators, graph[symbol]):
+                depth = 1
+                for s in symbols:
+                    depth = max(depth, min_depths.get(s, 0) + 1)
+                creator_depths[creator] = depth
+        return creator_depths
+
+    def _compute_termination_tables(self):
+        """Precomputes the creators eligible for each depth budget.
+
+        For every symbol, stores the depth needed by its deepest creator
+        together with a list of (depth, creators, alias_table) tuples
+        (ordered by depth) for the creators that terminate within smaller
+        depths. During generation, only creators that are guaranteed to
+        finish before the maximum recursion level can get selected, so
+        RecursionErrors don't have to be caught and retried.
+        """
+        graph = self._get_symbol_graph()
+        self._infer_nonrecursive(graph)
+        creator_depths = self._compute_min_depths(graph)
+
+        for symbol, creators in self._creators.items():
+            depths = [creator_depths[creator] for creator in creators]
+            max_depth = max(depths)
+            restricted = []
+            for depth in sorted(set(depths)):
+                if depth == max_depth:
+                    break
+                eligible = [
+                    creator for creator in creators
+                    if creator_depths[creator] <= depth
+                ]
+                cdf = self._get_cdf(symbol, eligible)
+                restricted.append(
+                    (depth, eligible, self._get_alias_table(cdf)))
+            self._termination_tables[symbol] = (max_depth, restricted)
+
+    def _compute_shortest_creators(self):
+        """Finds the creator with the shortest expansion of every symbol.
+
+        The length of a creator is the length of its constant text plus
+        the shortest lengths of the symbols it refers to and the typical
+        lengths of its built-in types and new variables, counting other
+        tags as a single byte. Ties are broken by the expansion depth, so
+        following the shortest creators always terminates.
+        """
+        graph = self._get_symbol_graph()
+        infinity = (float('inf'), float('inf'))
+        text_lengths = {}
+        for creators in self._creators.values():
+            for creator in creators:
+                length = 0
+                for part in creator.parts:
+                    if part.kind == _TEXT:
+                        length += len(part.text)
+                    elif part.kind == _BUILT_IN:
+                        length += _get_built_in_length(part.attributes)
+                    elif part.kind == _NEW_VAR:
+                        length += self._get_new_var_length(part.tagname)
+                    elif part.kind != _SYMBOL:
+                        length += 1
+                text_lengths[creator] = length
+        shortest = dict((symbol, infinity) for symbol in self._creators)
+        shortest_creators = {}
+        changed = True
+        while changed:
+            changed = False
+            for symbol, creator_symbols in graph.items():
+                best = shortest[symbol]
+                for creator, symbols in zip(self._creators[symbol],
+                                            creator_symbols):
+                    length = text_lengths[creator]
+                    depth = 1
+                    for s in symbols:
+                        child_length, child_depth = shortest.get(s, (1, 0))
+                        length += child_length
+                        depth = max(depth, child_depth + 1)
+                    if (length, depth) < best:
+                        best = (length, depth)
+                        shortest_creators[symbol] = creator
+                if best < shortest[symbol]:
+                    shortest[symbol] = best
+                    changed = True
+        self._shortest_creators = shortest_creators
+        self._shortest_lengths = dict(
+            (symbol, length) for symbol, (length, _) in shortest.items()
+            if length != float('inf'))
+
+        self._creator_lengths = {}
+        self._max_creator_lengths = {}
+        for symbol, creator_symbols in graph.items():
+            max_length = 0
+            for creator, symbols in zip(self._creators[symbol],
+                                        creator_symbols):
+                length = text_lengths[creator] + sum(
+                    shortest.get(s, (1, 0))[0] for s in symbols)
+                self._creator_lengths[creator] = length
+                if length != float('inf'):
+                    max_length = max(max_length, length)
+            self._max_creator_lengths[symbol] = max_length
+
+        self._compute_length_tables()
+
+    def _compute_length_tables(self):
+        """Precomputes the creators that fit into each length bucket.
+
+        The buckets are limited by the powers of two and 1.5 times the
+        powers of two (see _get_length_bucket). For every symbol, stores a
+        list of (creators, alias_table) tuples, one for each bucket below
+        the largest creator length, with the creators whose shortest
+        expansion fits into the limit of the bucket, or None if there are
+        none. A second list holds the same for the nonrecursive creators,
+        if the symbol has any. As with the termination tables, the
+        creators keep their relative probabilities.
+        """
+        self._length_tables = {}
+        for symbol, creators in self._creators.items():
+            tables = self._get_length_tables(
+                symbol, creators, self._max_creator_lengths[symbol])
+            nonrecursive_tables = None
+            if symbol in self._nonrecursive_creators:
+                nonrecursive_tables = self._get_length_tables(
+                    symbol, self._nonrecursive_creators[symbol],
+                    self._max_creator_lengths[symbol])
+            self._length_tables[symbol] = (tables, nonrecursive_tables)
+
+    def _get_length_tables(self, symbol, creators, max_length):
+        """Returns the length bucket tables for a list of creators."""
+        creator_lengths = self._creator_lengths
+        tables = []
+        previous = None
+        bucket = 0
+        while _get_length_bucket_limit(bucket) < max_length:
+            limit = _get_length_bucket_limit(bucket)
+            eligible = [creator for creator in creators
+                        if creator_lengths[creator] <= limit]
+            if not eligible:
+                table = None
+            elif previous is not None and len(eligible) == len(previous[0]):
+                table = previous
+            else:
+                cdf = self._get_cdf(symbol, eligible)
+                table = (eligible, self._get_alias_table(cdf))
+            tables.append(table)
+            previous = table
+            bucket += 1
+        return tables
+
+    def _find_problems(self):
+        """Finds rules that are going to fail during generation.
+
+        Indexes the symbols, functions and imports referred to by the
+        rules in a single pass and reports the ones that can't be
+        resolved, along with !extends parents that are neither symbols nor
+        types, and symbols that can never terminate. Rules of files
+        included with !lazy_include are only checked once they get parsed.
+
+        Returns:
+            A list of (kind, name, message) tuples, where kind is one of
+            'symbol', 'import', 'function', 'extends' and 'termination'.
+        """
+        # Name referred to -> rules referring to it, per kind.
+        references = {'symbol': {}, 'import': {}, 'function': {}}
+        for rule in self._all_rules:
+            for part in rule.parts:
+                if part.kind == _SYMBOL:
+                    if (part.tagname not in self._creators and
+                            part.tagname not in self._lazy_symbols):
+                        references['symbol'].setdefault(
+                            part.tagname, []).append(rule)
+                elif part.kind == _CALL:
+                    references['function'].setdefault(
+                        part.attributes.get('function'), []).append(rule)
+                elif part.tagname == 'import':
+                    references['import'].setdefault(
+                        part.attributes.get('from'), []).append(rule)
+                if part.beforeoutput is not None:
+                    references['function'].setdefault(
+                        part.beforeoutput, []).append(rule)
+
+        problems = []
+        for kind, names in sorted(references.items()):
+            for name, rules in sorted(names.items(),
+                                      key=lambda item: str(item[0])):
+                if kind == 'symbol':
+                    message = 'No creators for type ' + name
+                elif kind == 'function':
+                    if name in self._functions:
+                        continue
+                    if name is None:
+                        message = 'Call tag without a function attribute'
+                    else:
+                        message = 'Unknown function ' + name
+                elif name is None:
+                    message = 'import tag without from attribute'
+                else:
+                    message = 'Unknown import ' + name
+                message += ' (%d rules, e.g. %s)' % (
+                    len(rules), _format_rule(rules[0]))
+                problems.append((kind, name, message))
+
+        for objectname, parentnames in sorted(self._inheritance.items()):
+            for parentname in parentnames:
+                if (parentname not in self._creators and
+                        parentname not in self._lazy_symbols and
+                        parentname not in self._inheritance):
+                    problems.append((
+                        'extends', parentname,
+                        'Unknown parent type ' + parentname + ' of ' +
+                        objectname))
+
+        for symbol in sorted(self._min_depths):
+            if self._min_depths[symbol] == float('inf'):
+                problems.append((
+                    'termination', symbol,
+                    'Symbol ' + symbol + ' can never terminate'))
+        return problems
+
+    def _report_problems(self, problems):
+        """Prints the problems found by _find_problems().
+
+        Imports can still be added with add_import() after parsing, so
+        they are only checked by validate().
+        """
+        for kind, _, message in problems:
+            if kind != 'import':
+                print('Warning: ' + message)
+
+    def validate(self, kinds=None):
+        """Returns the problems found in the grammar.
+
+        The grammar is checked once when it gets parsed (or loaded from
+        the cache) and the problems, apart from imports, are printed as
+        warnings. Any of these would otherwise raise a GrammarError when
+        the rule that triggers it is expanded. Imports are checked against
+        the grammars known at the time of the call, so this should be
+        called after all add_import() calls.
+
+        Args:
+            kinds: Optional list of the kinds of problems to return, out of
+                'symbol', 'import', 'function', 'extends' and 'termination'.
+                All of them by default.
+
+        Returns:
+            A list of messages, empty if no problems were found.
+        """
+        messages = []
+        for kind, name, message in self._problems:
+            if kinds is not None and kind not in kinds:
+                continue
+            if kind == 'import' and (name in self._imports or
+                                     name in self._lazy_imports):
+                continue
+            messages.append(message)
+        return messages
 
     def _parse_tag_and_attributes(self, string):
         """Extracts tag name and attributes from a string."""
@@ -647,12 +2881,14 @@ class Grammar(object):
         if len(parts) < 1:
             raise GrammarError('Empty tag encountered')
         ret = {'type': 'tag'}
+        # Symbol names are interned, so that the lookups of the many
+        # tables keyed by symbol compare them by identity.
         if len(parts) > 1 and parts[0] == 'new':
-            ret['tagname'] = parts[1]
+            ret['tagname'] = sys.intern(parts[1])
             ret['new'] = 'true'
             attrstart = 2
         else:
-            ret['tagname'] = parts[0]
+            ret['tagname'] = sys.intern(parts[0])
             attrstart = 1
         for i in range(attrstart, len(parts)):
             attrparts = parts[i].split('=')
@@ -664,35 +2900,103 @@ class Grammar(object):
                 raise GrammarError('Error parsing tag ' + string)
         return ret
 
-    def _parse_code_line(self, line, helper_lines=False):
-        """Parses a rule for generating code."""
-        rule = {
-            'type': 'code',
-            'parts': [],
-            'creates': []
-        }
-        # Splits the line into constant parts and tags. For example
-        # "foo<bar>baz" would be split into three parts, "foo", "bar" and "baz"
-        # Every other part is going to be constant and every other part
-        # is going to be a tag, always starting with a constant. Empty
-        # spaces between tags/beginning/end are not a problem because
-        # then empty strings will be returned in corresponding places,
-        # for example "<foo><bar>" gets split into "", "foo", "", "bar", ""
-        rule_parts = re.split(r'<([^>)]*)>', line)
-        for i in range(0, len(rule_parts)):
-            if i % 2 == 0:
-                if rule_parts[i]:
-                    rule['parts'].append({
-                        'type': 'text',
-                        'text': rule_parts[i]
-                    })
+    def _create_part(self, tag, rule_type):
+        """Resolves the kind of a parsed tag and creates a rule part."""
+        tagname = tag['tagname']
+        part_id = tag.get('id')
+        beforeoutput = tag.get('beforeoutput')
+        attributes = None
+        if beforeoutput is not None:
+            attributes = tag
+        handler = None
+        text = None
+        if rule_type == 'code' and 'new' in tag:
+            kind = _NEW_VAR
+        elif tagname in self._constant_types:
+            text = self._constant_types[tagname]
+            if part_id is None and beforeoutput is None:
+                kind = _TEXT
             else:
-                parsedtag = self._parse_tag_and_attributes(rule_parts[i])
-                rule['parts'].append(parsedtag)
-                if 'new' in parsedtag:
-                    rule['creates'].append(parsedtag)
+                kind = _CONSTANT
+        elif tagname in self._built_in_types:
+            kind = _BUILT_IN
+            attributes = tag
+            handler = self._built_in_types[tagname].__func__
+        elif tagname == 'call':
+            kind = _CALL
+            attributes = tag
+        elif tagname == 'any':
+            kind = _ANY
+        else:
+            kind = _SYMBOL
+        return RulePart(kind, tagname, text, attributes,
+                        part_id, beforeoutput, handler)
+
+    def _parse_tag(self, string):
+        """Memoized _parse_tag_and_attributes.
+
+        Identical tags such as <int> or <Element> occur thousands of times
+        in a grammar and are only parsed once. The returned dictionary is
+        shared and must not be modified.
+        """
+        tag = self._tag_cache.get(string)
+        if tag is None:
+            tag = self._parse_tag_and_attributes(string)
+            self._tag_cache[string] = tag
+        return tag
+
+    def _tokenize_rule(self, text, rule_type):
+        """Splits the right-hand side of a rule into parts.
+
+        Splits the text into constant parts and tags. For example
+        "foo<bar>baz" is split into "foo", "bar" and "baz": every other
+        part is constant text and every other part is a tag, always
+        starting with text. Empty text between tags or at the ends is
+        skipped, e.g. "<foo><bar>" gets split into "", "foo", "", "bar", "".
+
+        Parts of tags are created once per tag and rule type and shared
+        between rules, except for the ones whose attributes get passed to
+        user-defined functions.
 
-        for tag in rule['creates']:
+        Returns:
+            A (parts, tags) tuple with the list of RulePart objects and the
+            list of the parsed tags.
+        """
+        tokens = _TAG_PATTERN.split(text)
+        parts = []
+        tags = []
+        if tokens[0]:
+            parts.append(RulePart(_TEXT, text=tokens[0]))
+        part_cache = self._part_cache
+        for i in range(1, len(tokens), 2):
+            key = (tokens[i], rule_type)
+            cached = part_cache.get(key)
+            if cached is None:
+                tag = self._parse_tag(tokens[i])
+                part = self._create_part(tag, rule_type)
+                if part.kind == _CALL or part.beforeoutput is not None:
+                    part = self._create_part(dict(tag), rule_type)
+                else:
+                    part_cache[key] = (tag, part)
+            else:
+                tag, part = cached
+            parts.append(part)
+            tags.append(tag)
+            if tokens[i + 1]:
+                parts.append(RulePart(_TEXT, text=tokens[i + 1]))
+        return parts, tags
+
+    def _parse_code_line(self, line, helper_lines=False):
+        """Parses a rule for generating code."""
+        parts, tags = self._tokenize_rule(line, 'code')
+        creates = [tag for tag in tags if 'new' in tag]
+        rule = Rule('code', tuple(parts), creates)
+        self._add_code_rule(rule, helper_lines)
+        return rule
+
+    def _add_code_rule(self, rule, helper_lines):
+        """Stores a code rule in the appropriate sets."""
+        for tag in rule.creates:
             tag_name = tag['tagname']
             if tag_name in _NONINTERESTING_TYPES:
                 continue
@@ -717,51 +3021,38 @@ class Grammar(object):
     def _parse_grammar_line(self, line):
         """Parses a grammar rule."""
         # Check if the line matches grammar rule pattern (<tagname> = ...).
-        match = re.match(r'^<([^>]*)>\s*=\s*(.*)$', line)
+        match = _GRAMMAR_RULE_PATTERN.match(line)
         if not match:
             raise GrammarError('Error parsing rule ' + line)
 
         # Parse the line to create a grammar rule.
-        rule = {
-            'type': 'grammar',
-            'creates': self._parse_tag_and_attributes(match.group(1)),
-            'parts': []
-        }
-        rule_parts = re.split(r'<([^>)]*)>', match.group(2))
-        rule['recursive'] = False
-        # Splits the line into constant parts and tags. For example
-        # "foo<bar>baz" would be split into three parts, "foo", "bar" and "baz"
-        # Every other part is going to be constant and every other part
-        # is going to be a tag, always starting with a constant. Empty
-        # spaces between tags/beginning/end are not a problem because
-        # then empty strings will be returned in corresponding places,
-        # for example "<foo><bar>" gets split into "", "foo", "", "bar", ""
-        for i in range(0, len(rule_parts)):
-            if i % 2 == 0:
-                if rule_parts[i]:
-                    rule['parts'].append({
-                        'type': 'text',
-                        'text': rule_parts[i]
-                    })
-            else:
-                parsedtag = self._parse_tag_and_attributes(rule_parts[i])
-                rule['parts'].append(parsedtag)
-                if parsedtag['tagname'] == rule['creates']['tagname']:
-                    rule['recursive'] = True
-
-        # Store the rule in appropriate sets.
-        create_tag_name = rule['creates']['tagname']
+        creates = self._parse_tag(match.group(1))
+        create_tag_name = creates['tagname']
+        parts, tags = self._tokenize_rule(match.group(2), 'grammar')
+        recursive = False
+        for tag in tags:
+            if tag['tagname'] == create_tag_name:
+                recursive = True
+                break
+        rule = Rule('grammar', tuple(parts), creates, recursive)
+        self._add_grammar_rule(rule)
+        return rule
+
+    def _add_grammar_rule(self, rule):
+        """Stores a grammar rule in the appropriate sets."""
+        creates = rule.creates
+        create_tag_name = creates['tagname']
         if create_tag_name in self._creators:
             self._creators[create_tag_name].append(rule)
         else:
             self._creators[create_tag_name] = [rule]
-        if 'nonrecursive' in rule['creates']:
+        if 'nonrecursive' in creates:
             if create_tag_name in self._nonrecursive_creators:
                 self._nonrecursive_creators[create_tag_name].append(rule)
             else:
                 self._nonrecursive_creators[create_tag_name] = [rule]
         self._all_rules.append(rule)
-        if 'root' in rule['creates']:
+        if 'root' in creates:
             self._root = create_tag_name
 
     def _remove_comments(self, line):
@@ -804,9 +3095,24 @@ class Grammar(object):
         return '\n'.join(output)
 
     def _save_function(self, name, source):
+        """Compiles the body of a user-defined function.
+
+        The body becomes the body of a Python function that takes the
+        attributes, context and ret_val arguments and returns ret_val. The
+        stored code object only defines the function, which keeps it
+        cacheable, see _get_function.
+        """
         source = self._fix_idents(source)
         try:
-            compiled_fn = compile(source, name, 'exec')
+            body = ast.parse(source, name).body
+            module = ast.parse('def %s(attributes, context, ret_val): pass'
+                               % _USER_FUNCTION_NAME)
+            return_statement = ast.parse('return ret_val').body[0]
+            if body:
+                ast.copy_location(return_statement, body[-1])
+            module.body[0].body = body + [return_statement]
+            compiled_fn = compile(ast.fix_missing_locations(module),
+                                  name, 'exec')
         except (SyntaxError, TypeError) as e:
             raise GrammarError('Error in user-defined function: %s' % str(e))
         self._functions[name] = compiled_fn
@@ -846,14 +3152,53 @@ class Grammar(object):
         self._inheritance[objectname].append(parentname)
 
     def _import_grammar(self, filename):
-        """Imports a grammar from another file."""
+        """Imports a grammar from another file.
+
+        The file is only parsed when the first <import> tag refers to it.
+        """
         basename = os.path.basename(filename)
         path = os.path.join(self._definitions_dir, filename)
+        if not os.path.isfile(path):
+            raise GrammarError('Error reading ' + filename)
+        # The path gets stored in the cache, which can be loaded from a
+        # different working directory.
+        self._lazy_imports[basename] = os.path.abspath(path)
+
+    def _load_import(self, name):
+        """Parses a grammar imported with !import.
+
+        The imported grammar gets the same settings as this grammar.
+        """
+        path = self._lazy_imports.pop(name)
         subgrammar = Grammar()
         num_errors = subgrammar.parse_from_file(path)
         if num_errors:
-            raise GrammarError('There were errors when parsing ' + filename)
-        self._imports[basename] = subgrammar
+            raise GrammarError('There were errors when parsing ' + path)
+        if self._compile:
+            subgrammar.compile_rules()
+        if self._stack_engine:
+            subgrammar.set_engine('stack')
+        subgrammar.set_random_pool(self._random_pool)
+        if self._profiler is not None:
+            subgrammar.set_profiler(self._profiler)
+        self._imports[name] = subgrammar
+        self._imported_files[name] = subgrammar
+        self._source_files.extend(subgrammar._source_files)
+
+    def set_random_pool(self, pool):
+        """Serves built-in types from a RandomPool.
+
+        Values of built-in types (<int>, <float>, <string> etc.) then get
+        drawn from the pool instead of the random module. Creator
+        selection still uses the random module. The pool is also used by
+        the grammars imported with !import.
+
+        Args:
+            pool: A RandomPool object, or None to use the random module.
+        """
+        self._random_pool = pool
+        for grammar in self._imported_files.values():
+            grammar.set_random_pool(pool)
 
     def add_import(self, name, grammar):
         """Adds a grammar that can then be used from <import> tags.
@@ -868,7 +3213,17 @@ class Grammar(object):
 
         self._imports[name] = grammar
 
-    def _include_from_string(self, grammar_str):
+    def _include_from_string(self, grammar_str, fragment=None):
+        """Parses the lines of a grammar into this grammar.
+
+        Args:
+            grammar_str: String containing the grammar.
+            fragment: Optional list to record the parsed rules, commands
+                and functions in, see _merge_fragment.
+
+        Returns:
+            Number of errors encountered during the parsing.
+        """
         in_code = False
         helper_lines = False
         in_function = False
@@ -884,12 +3239,17 @@ class Grammar(object):
                 cleanline = line
 
             # Process special commands
-            match = re.match(r'^!([a-z_]+)\s*(.*)$', cleanline)
+            if cleanline.startswith('!'):
+                match = _COMMAND_PATTERN.match(cleanline)
+            else:
+                match = None
             if match:
                 command = match.group(1)
                 params = match.group(2)
                 if command in self._command_handlers:
                     self._command_handlers[command](params)
+                    if fragment is not None:
+                        fragment.append(('command', command, params))
                 elif command == 'begin' and params == 'lines':
                     in_code = True
                     helper_lines = False
@@ -900,7 +3260,7 @@ class Grammar(object):
                     if in_code:
                         in_code = False
                 elif command == 'begin' and params.startswith('function'):
-                    match = re.match(r'^function\s*([a-zA-Z._0-9]+)$', params)
+                    match = _FUNCTION_PATTERN.match(params)
                     if match and not in_function:
                         function_name = match.group(1)
                         function_body = ''
@@ -912,6 +3272,10 @@ class Grammar(object):
                     if in_function:
                         in_function = False
                         self._save_function(function_name, function_body)
+                        if fragment is not None:
+                            fragment.append(
+                                ('function', function_name,
+                                 self._functions[function_name]))
                 else:
                     print('Unknown command: ' + command)
                     num_errors += 1
@@ -921,9 +3285,17 @@ class Grammar(object):
                 if in_function:
                     function_body += cleanline + '\n'
                 elif in_code:
-                    self._parse_code_line(cleanline, helper_lines)
+                    rule = self._parse_code_line(cleanline, helper_lines)
+                    if fragment is not None:
+                        fragment.append(('rule', rule.type, rule.parts,
+                                         rule.creates, rule.recursive,
+                                         helper_lines))
                 else:
-                    self._parse_grammar_line(cleanline)
+                    rule = self._parse_grammar_line(cleanline)
+                    if fragment is not None:
+                        fragment.append(('rule', rule.type, rule.parts,
+                                         rule.creates, rule.recursive,
+                                         False))
             except GrammarError:
                 print('Error parsing line ' + line)
                 num_errors += 1
@@ -939,16 +3311,162 @@ class Grammar(object):
         except IOError:
             print('Error reading ' + filename)
             return 1
+        self._add_source_file(filepath, content)
 
         # we temporarily change the definitions dir to make it relative to the
         # current file being parsed so that we can safely recursively
         # include/import other files from it.
         saved_definitions_dir = self._definitions_dir
         self._definitions_dir = os.path.dirname(filepath)
-        errors = self.parse_from_string(content)
+        self._include_level += 1
+        errors = self._include_cached(filepath, content)
+        if not errors:
+            errors = self._finish_parsing()
+        self._include_level -= 1
         self._definitions_dir = saved_definitions_dir
         return errors
 
+    def _include_cached(self, filepath, content):
+        """Parses the content of a file, reusing earlier parses.
+
+        Every file that parses without errors is kept as a fragment in a
+        cache shared by all the grammars of the process, keyed by path and
+        content. Including the same file again, in this or any other
+        grammar, merges a copy of the fragment instead of parsing the file
+        again, so no two grammars share rule parts or their attributes.
+
+        Returns:
+            Number of errors encountered during the parsing.
+        """
+        key = (os.path.abspath(filepath),
+               hashlib.sha1(content.encode('utf-8')).hexdigest())
+        fragment = _fragment_cache.get(key)
+        if fragment is not None:
+            self._merge_fragment(fragment)
+            return 0
+        fragment = []
+        errors = self._include_from_string(content, fragment)
+        if not errors:
+            _fragment_cache[key] = _copy_fragment(fragment)
+        return errors
+
+    def _merge_fragment(self, fragment):
+        """Adds the rules, commands and functions of a parsed fragment.
+
+        The effect is the same as parsing the file the fragment was
+        recorded from again. Every grammar gets its own copies of the
+        rules, their parts and the attributes of the parts, so that
+        neither compile_rules() nor user-defined functions changing
+        attributes affect other grammars.
+        """
+        for entry in _copy_fragment(fragment):
+            if entry[0] == 'rule':
+                rule_type, parts, creates, recursive, helper_lines = entry[1:]
+                rule = Rule(rule_type, parts, creates, recursive)
+                if rule_type == 'grammar':
+                    self._add_grammar_rule(rule)
+                else:
+                    self._add_code_rule(rule, helper_lines)
+            elif entry[0] == 'command':
+                self._command_handlers[entry[1]](entry[2])
+            else:
+                self._functions[entry[1]] = entry[2]
+
+    def _lazy_include_from_file(self, filename):
+        """Includes a file whose rules are parsed on first use.
+
+        The file is only scanned for the symbols it defines. Its rules get
+        parsed when one of these symbols is needed for the first time.
+        Files that contain anything but grammar rules (commands, code or
+        functions) or the root symbol are included right away.
+        """
+        filepath = os.path.join(self._definitions_dir, filename)
+        try:
+            f = open(filepath)
+            content = f.read()
+            f.close()
+        except IOError:
+            print('Error reading ' + filename)
+            return 1
+
+        symbols = self._scan_rule_symbols(content)
+        if symbols is None:
+            return self._include_from_file(filename)
+
+        self._add_source_file(filepath, content)
+        self._lazy_files[filepath] = (content, symbols)
+        for symbol in symbols:
+            self._lazy_symbols.setdefault(symbol, []).append(filepath)
+        return 0
+
+    def _scan_rule_symbols(self, content):
+        """Returns the symbols defined in a file with only grammar rules.
+
+        Returns:
+            A list of symbols or None if the file has anything else.
+        """
+        symbols = set()
+        for line in content.split('\n'):
+            cleanline = self._remove_comments(line)
+            if not cleanline:
+                continue
+            match = _RULE_LINE_PATTERN.match(cleanline)
+            if not match:
+                return None
+            tag = match.group(1).split()
+            if not tag or 'root' in tag[1:]:
+                return None
+            symbols.add(tag[0])
+        return sorted(symbols)
+
+    def _load_lazy_symbol(self, symbol):
+        """Parses the lazily included files that define a symbol.
+
+        Returns:
+            True if there were any, False otherwise.
+        """
+        filepaths = self._lazy_symbols.get(symbol)
+        if not filepaths:
+            return False
+        for filepath in list(filepaths):
+            self._load_lazy_file(filepath)
+        if not self._include_level:
+            self._compute_termination_tables()
+            self._normalize_probabilities()
+            if self._shortest_creators is not None:
+                self._compute_shortest_creators()
+            known = set(problem[:2] for problem in self._problems)
+            problems = self._find_problems()
+            self._report_problems(
+                [problem for problem in problems
+                 if problem[:2] not in known])
+            self._problems = problems
+        return True
+
+    def _load_lazy_file(self, filepath):
+        """Parses the rules of a file included with !lazy_include."""
+        content, symbols = self._lazy_files.pop(filepath)
+        for symbol in symbols:
+            filepaths = self._lazy_symbols[symbol]
+            filepaths.remove(filepath)
+            if not filepaths:
+                del self._lazy_symbols[symbol]
+
+        num_rules = len(self._all_rules)
+        saved_definitions_dir = self._definitions_dir
+        self._definitions_dir = os.path.dirname(filepath)
+        self._include_level += 1
+        try:
+            errors = self._include_cached(filepath, content)
+        finally:
+            self._include_level -= 1
+            self._definitions_dir = saved_definitions_dir
+        if errors:
+            raise GrammarError('There were errors when parsing ' + filepath)
+        if self._tag_hook_points:
+            for rule in self._all_rules[num_rules:]:
+                self._add_tag_hook_points(rule)
+
     def parse_from_string(self, grammar_str):
         """Parses grammar rules from string.
 
@@ -964,13 +3482,40 @@ class Grammar(object):
         errors = self._include_from_string(grammar_str)
         if errors:
             return errors
+        return self._finish_parsing()
+
+    def _finish_parsing(self):
+        """Prepares the tables used for generation after parsing.
 
-        self._normalize_probabilities()
+        Returns:
+            Number of errors encountered.
+        """
+        # The analysis needs the whole grammar, skip it for included files.
+        if not self._include_level:
+            # Symbols that also have eagerly parsed rules never get looked
+            # up, so the lazily included files defining them are parsed now.
+            try:
+                for symbol in list(self._lazy_symbols):
+                    if symbol in self._creators and symbol in self._lazy_symbols:
+                        for filepath in list(self._lazy_symbols[symbol]):
+                            self._load_lazy_file(filepath)
+            except GrammarError as e:
+                print(str(e))
+                return 1
+            self._compute_termination_tables()
+            self._normalize_probabilities()
+            self._tag_cache = {}
+            self._part_cache = {}
+            self._problems = self._find_problems()
+            self._report_problems(self._problems)
+            self._compute_extends_closures()
         self._compute_interesting_indices()
+        if not self._include_level:
+            self._compute_interesting_line_sets()
 
         return 0
 
-    def parse_from_file(self, filename, extra=None):
+    def parse_from_file(self, filename, extra=None, cache_dir=None):
         """Parses grammar from file.
 
         Opens a text file, parses it and loads the grammar rules within.
@@ -979,6 +3524,10 @@ class Grammar(object):
 
         Args:
             filename: path to the file with grammar rules.
+            extra: optional grammar string prepended to the file contents.
+            cache_dir: optional directory for caching the parsed grammar.
+                The cached grammar is used as long as neither the file nor
+                any of the files it includes or imports have changed.
 
         Returns:
             Number of errors encountered during the parsing.
@@ -991,11 +3540,107 @@ class Grammar(object):
             print('Error reading ' + filename)
             return 1
         self._definitions_dir = os.path.dirname(filename)
-        
+        self._add_source_file(filename, content)
+
         if extra:
             content = extra + content
 
-        return self.parse_from_string(content)
+        if cache_dir:
+            cache_path = self._get_cache_path(cache_dir, filename, content)
+            if self._load_from_cache(cache_path):
+                self._report_problems(self._problems)
+                return 0
+
+        errors = self._include_cached(filename, content)
+        if not errors:
+            errors = self._finish_parsing()
+        if cache_dir and not errors:
+            self._save_to_cache(cache_path)
+        return errors
+
+    def _add_source_file(self, filename, content):
+        digest = hashlib.sha1(content.encode('utf-8')).hexdigest()
+        self._source_files.append((os.path.abspath(filename), digest))
+
+    def _get_cache_path(self, cache_dir, filename, content):
+        """Returns the cache file for a given root grammar file."""
+        key = hashlib.sha1()
+        key.update(str((_CACHE_VERSION, sys.version_info[:2])).encode('utf-8'))
+        key.update(os.path.abspath(filename).encode('utf-8'))
+        key.update(content.encode('utf-8'))
+        return os.path.join(cache_dir, key.hexdigest() + '.cache')
+
+    def _get_cache_state(self):
+        """Returns the parsed state of the grammar in a picklable form."""
+        state = {}
+        for name in _CACHED_ATTRIBUTES:
+            state[name] = getattr(self, name)
+        # Code objects can't be pickled, marshal them instead.
+        state['_functions'] = dict(
+            (name, marshal.dumps(code))
+            for name, code in self._functions.items())
+        state['_imports'] = dict(
+            (name, grammar._get_cache_state())
+            for name, grammar in self._imported_files.items())
+        return state
+
+    def _set_cache_state(self, state):
+        """Restores the grammar state returned by _get_cache_state."""
+        for name in _CACHED_ATTRIBUTES:
+            setattr(self, name, state[name])
+        self._compute_interesting_line_sets()
+        for name, code in state['_functions'].items():
+            self._functions[name] = marshal.loads(code)
+        for name, import_state in state['_imports'].items():
+            subgrammar = Grammar()
+            subgrammar._set_cache_state(import_state)
+            self._imports[name] = subgrammar
+            self._imported_files[name] = subgrammar
+
+    def _load_from_cache(self, cache_path):
+        """Loads the grammar from cache if the cache is up to date.
+
+        Returns:
+            True if the grammar was loaded, False otherwise.
+        """
+        try:
+            with open(cache_path, 'rb') as f:
+                state = pickle.load(f)
+        except Exception:
+            return False
+
+        # The cache key only covers the root file, check that none of the
+        # included or imported files have changed since.
+        for path, digest in state['_source_files']:
+            try:
+                with open(path) as f:
+                    content = f.read()
+            except IOError:
+                return False
+            if hashlib.sha1(content.encode('utf-8')).hexdigest() != digest:
+                return False
+
+        self._set_cache_state(state)
+        return True
+
+    def _save_to_cache(self, cache_path):
+        """Stores the parsed grammar into the cache directory."""
+        cache_dir = os.path.dirname(cache_path)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            # Write to a temporary file first so that concurrent generator
+            # processes never see a partially written cache file.
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir)
+        except OSError:
+            print('Error writing grammar cache ' + cache_path)
+            return
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(self._get_cache_state(), f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, cache_path)
+        except (OSError, pickle.PicklingError):
+            print('Error writing grammar cache ' + cache_path)
+            os.unlink(tmp_path)
 
     def _compute_interesting_indices(self):
         # select interesting lines for each variable type
@@ -1006,30 +3651,87 @@ class Grammar(object):
         for i in range(len(self._creators['line'])):
             self._all_nonhelper_lines.append(i)
             rule = self._creators['line'][i]
-            for part in rule['parts']:
-                if part['type'] == 'text':
+            for part in rule.parts:
+                tagname = part.tagname
+                if tagname is None:
                     continue
-                tagname = part['tagname']
                 if tagname in _NONINTERESTING_TYPES:
                     continue
-                if 'new' in part:
+                if part.kind == _NEW_VAR:
                     continue
                 if tagname not in self._interesting_lines:
                     self._interesting_lines[tagname] = []
                 self._interesting_lines[tagname].append(i)
 
+    def _compute_extends_closures(self):
+        """Finds all the types each type extends, directly or not.
+
+        A new variable is also a variable of every type its type extends
+        with !extends. For every type that extends others, stores the list
+        of types the variable gets added as: the type itself followed by
+        its parents in depth-first order. A type reachable over several
+        paths is listed once per path. Circular !extends chains are cut
+        off.
+        """
+        self._extends_closures = {}
+        for var_type in self._inheritance:
+            closure = []
+            self._collect_extends_closure(var_type, [], closure)
+            self._extends_closures[var_type] = closure
+
+    def _collect_extends_closure(self, var_type, path, closure):
+        closure.append(var_type)
+        path.append(var_type)
+        for parent_type in self._inheritance.get(var_type, ()):
+            if parent_type not in path:
+                self._collect_extends_closure(parent_type, path, closure)
+        path.pop()
+
+    def _compute_interesting_line_sets(self):
+        """Converts the interesting lines of every type to a set.
+
+        The sets aren't cached: a set restored by pickle can iterate in a
+        different order, and _add_variable relies on that order.
+        """
+        self._interesting_line_sets = dict(
+            (var_type, set(lines))
+            for var_type, lines in self._interesting_lines.items())
+
     def _add_variable(self, var_name, var_type, context):
-        if var_type not in context['variables']:
-            context['variables'][var_type] = []
-            if var_type in self._interesting_lines:
-                set1 = set(context['interesting_lines'])
-                set2 = set(self._interesting_lines[var_type])
-                new_interesting = set2 - set1
-                context['interesting_lines'] += list(new_interesting)
-        context['variables'][var_type].append(var_name)
-        if var_type in self._inheritance:
-            for parent_type in self._inheritance[var_type]:
-                self._add_variable(var_name, parent_type, context)
+        variables = context.variables
+        for var_type in self._extends_closures.get(var_type, (var_type,)):
+            if var_type not in variables:
+                variables[var_type] = []
+                context.variable_types.append(var_type)
+                if var_type in self._interesting_line_sets:
+                    # Same as the difference of the set of all the
+                    # interesting lines, which gives the same order.
+                    new_interesting = list(
+                        self._interesting_line_sets[var_type] -
+                        context.interesting_line_set)
+                    context.interesting_lines += new_interesting
+                    context.interesting_line_set.update(new_interesting)
+            variables[var_type].append(var_name)
+            context.journal.append(var_type)
+
+    def _get_variable_line(self, var_name, var_type):
+        """Returns the line of code that registers a new variable."""
+        return ("if (!" + var_name + ") { " + var_name +
+                " = GetVariable(fuzzervars, '" + var_type + "'); } else { " +
+                self._get_variable_setters(var_name, var_type) + " }")
+
+    def _get_new_var_length(self, var_type):
+        """Estimates the bytes a new variable adds to the lines of code.
+
+        Besides its declaration, a variable of an interesting type gets a
+        line of its own, see _finish_code_rule.
+        """
+        var_name = self._var_format % 1
+        length = len('/* newvar{' + var_name + ':' + var_type + '} */ var ' +
+                     var_name)
+        if var_type not in _NONINTERESTING_TYPES:
+            length += len(self._get_variable_line(var_name, var_type)) + 1
+        return length
 
     def _get_variable_setters(self, var_name, var_type):
         ret = "SetVariable(fuzzervars, " + var_name + ", '" + var_type + "'); "
@@ -1039,6 +3741,6 @@ class Grammar(object):
         return ret
 
     def _get_any_var(self, context):
-        var_type = random.choice(list(context['variables'].keys()))
-        return random.choice(context['variables'][var_type])
+        var_type = random.choice(context.variable_types)
+        return random.choice(context.variables[var_type])
 
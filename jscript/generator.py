@@ -25,7 +25,7 @@ import sys
 
 parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
 sys.path.append(parent_dir)
-from grammar import Grammar
+from grammar import Grammar, Template
 
 _N_MAIN_LINES = 1000
 _N_EVENTHANDLER_LINES = 500
@@ -42,11 +42,17 @@ def generate_function_body(jsgrammar, num_lines):
       js += 'return vars[' + str(random.randint(0,99)) + '];\n'
     return js
 
+def parse_template(template):
+    """Parses a template string, see grammar.Template.parse."""
+    return Template.parse(template, ['jsfuzzer'], 'jsfuzzer',
+                          _N_MAIN_LINES, _N_EVENTHANDLER_LINES)
+
+
 def GenerateNewSample(template, jsgrammar):
     """Parses grammar rules from string.
 
     Args:
-      template: A template string.
+      template: A Template returned by parse_template.
       htmlgrammar: Grammar for generating HTML code.
       cssgrammar: Grammar for generating CSS code.
       jsgrammar: Grammar for generating JS code.
@@ -55,22 +61,10 @@ def GenerateNewSample(template, jsgrammar):
       A string containing sample data.
     """
 
-    result = template
-
-    handlers = False
-    while '<jsfuzzer>' in result:
-        numlines = _N_MAIN_LINES
-        if handlers:
-            numlines = _N_EVENTHANDLER_LINES
-        else:
-            handlers = True
-        result = result.replace(
-            '<jsfuzzer>',
-            generate_function_body(jsgrammar, numlines),
-            1
-        )
-
-    return result
+    return template.fill({
+        'jsfuzzer': lambda attributes, sink: generate_function_body(
+            jsgrammar, int(attributes['lines']))
+    })
 
 
 def generate_samples(grammar_dir, outfiles):
@@ -82,7 +76,7 @@ def generate_samples(grammar_dir, outfiles):
     """
 
     f = open(os.path.join(grammar_dir, 'template.html'))
-    template = f.read()
+    template = parse_template(f.read())
     f.close()
 
     jsgrammar = Grammar()
@@ -90,6 +84,7 @@ def generate_samples(grammar_dir, outfiles):
     if err > 0:
         print('There were errors parsing grammar')
         return
+    jsgrammar.compile_rules()
 
     for outfile in outfiles:
         result = GenerateNewSample(template, jsgrammar)
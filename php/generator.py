@@ -25,38 +25,33 @@ import sys
 
 parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
 sys.path.append(parent_dir)
-from grammar import Grammar
+from grammar import Grammar, Template
 
 _N_MAIN_LINES = 1000
 _N_EVENTHANDLER_LINES = 500
 
 
+def parse_template(template):
+    """Parses a template string, see grammar.Template.parse."""
+    return Template.parse(template, ['phpfuzzer'], 'phpfuzzer',
+                          _N_MAIN_LINES, _N_EVENTHANDLER_LINES)
+
+
 def generate_new_sample(template, phpgrammar):
     """Parses grammar rules from string.
 
     Args:
-      template: A template string.
+      template: A Template returned by parse_template.
       phpgrammar: Grammar for generating PHPcode.
 
     Returns:
       A string containing sample data.
     """
 
-    result = template
-    handlers = False
-    while '<phpfuzzer>' in result:
-        numlines = _N_MAIN_LINES
-        if handlers:
-            numlines = _N_EVENTHANDLER_LINES
-        else:
-            handlers = True
-        result = result.replace(
-            '<phpfuzzer>',
-            phpgrammar._generate_code(numlines),
-            1
-        )
-
-    return result
+    return template.fill({
+        'phpfuzzer': lambda attributes, sink: phpgrammar._generate_code(
+            int(attributes['lines']))
+    })
 
 
 def generate_samples(grammar_dir, outfiles):
@@ -68,7 +63,7 @@ def generate_samples(grammar_dir, outfiles):
     """
 
     f = open(os.path.join(grammar_dir, 'template.php'))
-    template = f.read()
+    template = parse_template(f.read())
     f.close()
 
     phpgrammar = Grammar()
@@ -76,6 +71,7 @@ def generate_samples(grammar_dir, outfiles):
     if err > 0:
         print('There were errors parsing grammar')
         return
+    phpgrammar.compile_rules()
 
     for outfile in outfiles:
         result = generate_new_sample(template, phpgrammar)
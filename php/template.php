@@ -168,6 +168,6 @@ $ref_object = new StdClass();
 $ref_resource = fopen("/dev/null", "r");
 $ref_path = "/dev/null";
 
-<phpfuzzer>
+<phpfuzzer lines=1000>
 
 ?>
@@ -0,0 +1,441 @@
+#   Domato - generator server
+#   --------------------------------------
+#
+#   Copyright 2017 Google Inc. All Rights Reserved.
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Serves generated samples to long-running clients.
+
+The grammars are parsed once and samples are then generated on request,
+over a Unix domain socket or over stdin/stdout.
+
+Every message, in both directions, is a _MESSAGE_HEADER (header length,
+payload length) followed by a UTF-8 encoded JSON header and the payload.
+Requests have no payload. Their header can contain:
+
+    command:   'generate' (the default) or 'stats'
+    target:    the name of the template to fill, 'html' by default
+    seed:      the 64-bit seed of the sample, derived from the seed of the
+               server and the number of the request if missing
+    max_bytes: limit on the size of the sample, split evenly between the
+               placeholders of the template as their bytes= attribute.
+               The text of the template comes on top and a placeholder
+               gets at least the shortest content its grammar can
+               generate, so samples can end up larger.
+
+The header of a response has a status, 'ok' or 'error'. Samples are sent
+as the payload, with their seed and target in the header. The seed can
+also be given to generator.py --regenerate. The header of the response
+to 'stats' contains the counters returned by SampleServer.get_stats().
+"""
+
+from __future__ import print_function
+import argparse
+import collections
+import contextlib
+import json
+import os
+import random
+import signal
+import socket
+import struct
+import sys
+import threading
+import time
+
+try:
+    import socketserver
+except ImportError:
+    socketserver = None
+
+import benchmark
+import generator
+
+_MESSAGE_HEADER = struct.Struct('<II')
+
+# Number of the most recent requests the latency percentiles are
+# computed from.
+_LATENCY_WINDOW = 10000
+
+# Templates with a budget applied, kept for reuse.
+_MAX_BUDGET_TEMPLATES = 64
+
+
+class ServerError(Exception):
+    """An exception class for errors reported by the server."""
+    pass
+
+
+def _read_exactly(f, size):
+    data = b''
+    while len(data) < size:
+        chunk = f.read(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def read_message(f):
+    """Reads a message from a binary file object.
+
+    Returns:
+        A (header, payload) tuple or None at the end of the stream.
+    """
+    lengths = _read_exactly(f, _MESSAGE_HEADER.size)
+    if lengths is None:
+        return None
+    header_length, payload_length = _MESSAGE_HEADER.unpack(lengths)
+    data = _read_exactly(f, header_length + payload_length)
+    if data is None:
+        return None
+    return (json.loads(data[:header_length].decode('utf-8')),
+            data[header_length:])
+
+
+def write_message(f, header, payload=b''):
+    """Writes a message to a binary file object."""
+    header = json.dumps(header).encode('utf-8')
+    f.write(_MESSAGE_HEADER.pack(len(header), len(payload)) + header +
+            payload)
+    f.flush()
+
+
+def _is_integer(value):
+    """Whether a JSON value is an integer. Python bools are ints too."""
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+class SampleServer(object):
+    """Generates samples for requests, from grammars parsed once.
+
+    Requests can come from several threads. The samples are generated one
+    at a time, the grammars are not thread-safe.
+    """
+
+    def __init__(self, templates, cache_dir=None, random_pool=False,
+                 seed=None):
+        """Parses the grammars.
+
+        Args:
+            templates: A dictionary mapping target names to template
+                strings.
+            cache_dir: Optional directory for caching parsed grammars.
+            random_pool: Whether to draw values of built-in types from a
+                RandomPool instead of the random module.
+            seed: The 64-bit seed the seeds of the samples are derived from
+                when a request doesn't specify one, random if None.
+        """
+        grammars = generator.load_grammars(cache_dir, random_pool)
+        if grammars is None:
+            raise ServerError('There were errors parsing the grammars')
+        self._grammars = grammars
+        self._templates = templates
+        self._budget_templates = {}
+        if seed is None:
+            seed = random.SystemRandom().getrandbits(64)
+        self._seed = seed
+
+        self._generate_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._start_time = time.time()
+        self._num_requests = 0
+        self._num_samples = 0
+        self._num_errors = 0
+        self._num_bytes = 0
+        self._samples_per_target = dict((name, 0) for name in templates)
+        self._latencies = collections.deque(maxlen=_LATENCY_WINDOW)
+
+    def get_seed(self):
+        return self._seed
+
+    def _get_template(self, target, max_bytes):
+        """Returns the parsed template of a target for a budget."""
+        key = (target, max_bytes)
+        template = self._budget_templates.get(key)
+        if template is not None:
+            return template
+        template = generator.parse_template(self._templates[target])
+        if max_bytes is not None:
+            placeholders = [attributes for name, attributes
+                            in template.segments if name is not None]
+            share = max(1, max_bytes // max(1, len(placeholders)))
+            for attributes in placeholders:
+                attributes['bytes'] = str(share)
+        if len(self._budget_templates) >= _MAX_BUDGET_TEMPLATES:
+            self._budget_templates.clear()
+        self._budget_templates[key] = template
+        return template
+
+    def generate(self, target='html', seed=None, max_bytes=None):
+        """Generates a sample.
+
+        Returns:
+            A (seed, data) tuple with the seed and the UTF-8 encoded sample.
+
+        Raises:
+            ServerError: If the request is invalid or generation failed.
+        """
+        if target not in self._templates:
+            raise ServerError('Unknown target ' + str(target))
+        if seed is not None and not (_is_integer(seed) and
+                                     0 <= seed < 2 ** 64):
+            raise ServerError('seed must be a 64-bit unsigned integer')
+        if max_bytes is not None and not (_is_integer(max_bytes) and
+                                          max_bytes > 0):
+            raise ServerError('max_bytes must be a positive integer')
+
+        start = time.perf_counter()
+        with self._generate_lock:
+            if seed is None:
+                seed = generator.get_sample_seed(self._seed,
+                                                 self._num_requests)
+            self._num_requests += 1
+            state = (self._get_template(target, max_bytes),) + self._grammars
+            try:
+                data, _ = generator.generate_sample_data(state, seed)
+            except Exception as e:
+                with self._stats_lock:
+                    self._num_errors += 1
+                raise ServerError('Error generating the sample: ' + str(e))
+        latency = time.perf_counter() - start
+
+        with self._stats_lock:
+            self._num_samples += 1
+            self._num_bytes += len(data)
+            self._samples_per_target[target] += 1
+            self._latencies.append(latency)
+        return seed, data
+
+    def get_stats(self):
+        """Returns the counters of the server.
+
+        Latencies are in seconds and include the time spent waiting for
+        other requests. The percentiles cover the last _LATENCY_WINDOW
+        samples.
+        """
+        with self._stats_lock:
+            latencies = sorted(self._latencies)
+            return {
+                'uptime': time.time() - self._start_time,
+                'samples': self._num_samples,
+                'errors': self._num_errors,
+                'bytes': self._num_bytes,
+                'targets': dict(self._samples_per_target),
+                'p50_latency': benchmark.get_percentile(latencies, 50),
+                'p90_latency': benchmark.get_percentile(latencies, 90),
+                'p99_latency': benchmark.get_percentile(latencies, 99)
+            }
+
+    def handle_request(self, request):
+        """Handles a request message.
+
+        Returns:
+            A (header, payload) tuple with the response.
+        """
+        command = request.get('command', 'generate')
+        if command == 'stats':
+            stats = self.get_stats()
+            stats['status'] = 'ok'
+            return stats, b''
+        elif command != 'generate':
+            return {'status': 'error',
+                    'error': 'Unknown command ' + str(command)}, b''
+        target = request.get('target', 'html')
+        try:
+            seed, data = self.generate(target, request.get('seed'),
+                                       request.get('max_bytes'))
+        except ServerError as e:
+            return {'status': 'error', 'error': str(e)}, b''
+        return {'status': 'ok', 'target': target, 'seed': seed}, data
+
+    def serve_stream(self, rfile, wfile):
+        """Answers the requests read from rfile until it ends."""
+        while True:
+            try:
+                message = read_message(rfile)
+            except ValueError:
+                write_message(wfile, {'status': 'error',
+                                      'error': 'Malformed request'})
+                return
+            if message is None:
+                return
+            if not isinstance(message[0], dict):
+                write_message(wfile, {'status': 'error',
+                                      'error': 'Malformed request'})
+                continue
+            header, payload = self.handle_request(message[0])
+            write_message(wfile, header, payload)
+
+
+def _stop_serving(signum, frame):
+    raise KeyboardInterrupt()
+
+
+def serve_unix_socket(server, path):
+    """Serves requests on a Unix domain socket, a thread per client."""
+    if socketserver is None or not hasattr(socketserver,
+                                           'ThreadingUnixStreamServer'):
+        print('Unix domain sockets are not supported on this platform')
+        return 1
+
+    class Handler(socketserver.StreamRequestHandler):
+
+        def handle(self):
+            try:
+                server.serve_stream(self.rfile, self.wfile)
+            except (IOError, OSError):
+                # The client went away.
+                pass
+
+    if os.path.exists(path):
+        os.unlink(path)
+    socket_server = socketserver.ThreadingUnixStreamServer(path, Handler)
+    socket_server.daemon_threads = True
+    # Terminating the server cleans up the socket just like Ctrl+C.
+    signal.signal(signal.SIGTERM, _stop_serving)
+    print('Listening on ' + path)
+    try:
+        socket_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        socket_server.server_close()
+        os.unlink(path)
+    return 0
+
+
+class GeneratorClient(object):
+    """Requests samples from a server listening on a Unix domain socket.
+
+    Usage example:
+    >>> with GeneratorClient('/tmp/domato.sock') as client:
+    ...     seed, data = client.generate(max_bytes=100000)
+    """
+
+    def __init__(self, path):
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.connect(path)
+        self._file = self._socket.makefile('rwb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _request(self, request):
+        write_message(self._file, request)
+        response = read_message(self._file)
+        if response is None:
+            raise ServerError('Connection closed by the server')
+        header, payload = response
+        if header['status'] != 'ok':
+            raise ServerError(header.get('error'))
+        return header, payload
+
+    def generate(self, target='html', seed=None, max_bytes=None):
+        """Requests a sample.
+
+        Returns:
+            A (seed, data) tuple with the seed and the UTF-8 encoded sample.
+        """
+        request = {'target': target}
+        if seed is not None:
+            request['seed'] = seed
+        if max_bytes is not None:
+            request['max_bytes'] = max_bytes
+        header, payload = self._request(request)
+        return header['seed'], payload
+
+    def get_stats(self):
+        header, _ = self._request({'command': 'stats'})
+        del header['status']
+        return header
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+
+def _parse_target(value):
+    """Parses a NAME=TEMPLATE_FILE target."""
+    name, separator, path = value.partition('=')
+    if not separator or not name or not path:
+        raise argparse.ArgumentTypeError('targets are given as NAME=FILE')
+    return name, path
+
+
+def get_argument_parser():
+
+    parser = argparse.ArgumentParser(description="DOMATO generator server")
+
+    parser.add_argument('address',
+                    help='path of the Unix domain socket to listen on, or - to serve a single client on stdin/stdout')
+
+    parser.add_argument('-t', '--target', type=_parse_target, action='append',
+                    metavar='NAME=FILE', default=[],
+                    help='serve a template as a target (html=template.html is always served unless overridden)')
+
+    parser.add_argument('-c', '--cache_dir', type=str,
+                    help='directory for caching parsed grammars between runs')
+
+    parser.add_argument('-r', '--random_pool', action='store_true',
+                    help='draw values of built-in types from pre-drawn blocks of random numbers')
+
+    parser.add_argument('-s', '--seed', type=generator._parse_seed,
+                    help='64-bit seed to derive the seeds of samples from when a request has none')
+    return parser
+
+
+def main():
+
+    parser = get_argument_parser()
+
+    args = parser.parse_args()
+
+    targets = [('html', os.path.join(os.path.dirname(os.path.abspath(
+        __file__)), 'template.html'))] + args.target
+    templates = {}
+    for name, path in targets:
+        with open(path) as f:
+            templates[name] = f.read()
+
+    if args.address == '-':
+        # stdout carries the responses, everything else goes to stderr.
+        rfile = sys.stdin.buffer
+        wfile = sys.stdout.buffer
+        with contextlib.redirect_stdout(sys.stderr):
+            try:
+                server = SampleServer(templates, args.cache_dir,
+                                      args.random_pool, args.seed)
+            except ServerError as e:
+                print(str(e))
+                return 1
+            print('Server seed: ' + str(server.get_seed()))
+            server.serve_stream(rfile, wfile)
+        return 0
+
+    try:
+        server = SampleServer(templates, args.cache_dir, args.random_pool,
+                              args.seed)
+    except ServerError as e:
+        print(str(e))
+        return 1
+    print('Server seed: ' + str(server.get_seed()))
+    return serve_unix_socket(server, args.address)
+
+
+if __name__ == '__main__':
+
+    sys.exit(main())
@@ -0,0 +1,113 @@
+#   Domato - grammar tests
+#   --------------------------------------
+#
+#   Copyright 2017 Google Inc. All Rights Reserved.
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Tests for grammar.py, run with python -m unittest discover tests."""
+
+from __future__ import print_function
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path.append(parent_dir)
+import grammar
+from grammar import Grammar
+
+
+class GrammarFileTest(unittest.TestCase):
+    """Base class for tests that parse grammars from files."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        grammar.clear_fragment_cache()
+
+    def tearDown(self):
+        grammar.clear_fragment_cache()
+        shutil.rmtree(self.tmp_dir)
+
+    def write_file(self, filename, content):
+        path = os.path.join(self.tmp_dir, filename)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def parse_file(self, path, **kwargs):
+        g = Grammar()
+        self.assertEqual(g.parse_from_file(path, **kwargs), 0)
+        return g
+
+
+class FragmentCacheTest(GrammarFileTest):
+
+    def test_attributes_not_shared_between_grammars(self):
+        self.write_file('shared.txt', (
+            '!begin function count\n'
+            '  attributes[\'calls\'] = attributes.get(\'calls\', 0) + 1\n'
+            '  ret_val = str(attributes[\'calls\'])\n'
+            '!end function\n'
+            '\n'
+            '<counter> = <call function=count>\n'
+        ))
+        root = '!include shared.txt\n<start root> = <counter>\n'
+        first = self.write_file('first.txt', root)
+        second = self.write_file('second.txt', root)
+
+        first_grammar = self.parse_file(first)
+        self.assertEqual(first_grammar.generate_root(), '1')
+        self.assertEqual(first_grammar.generate_root(), '2')
+
+        # Includes the parsed shared.txt from the cache.
+        second_grammar = self.parse_file(second)
+        self.assertEqual(second_grammar.generate_root(), '1')
+        self.assertEqual(first_grammar.generate_root(), '3')
+
+        third_grammar = self.parse_file(first)
+        self.assertEqual(third_grammar.generate_root(), '1')
+
+
+class CacheTest(GrammarFileTest):
+
+    def test_import_from_different_directory(self):
+        os.mkdir(os.path.join(self.tmp_dir, 'grammars'))
+        self.write_file(os.path.join('grammars', 'words.txt'),
+                        '<word root> = hello\n')
+        self.write_file(os.path.join('grammars', 'main.txt'), (
+            '!import words.txt\n'
+            '<start root> = <import from=words.txt>\n'
+        ))
+        cache_dir = os.path.join(self.tmp_dir, 'cache')
+
+        saved_cwd = os.getcwd()
+        try:
+            os.chdir(self.tmp_dir)
+            self.parse_file(os.path.join('grammars', 'main.txt'),
+                            cache_dir=cache_dir)
+            os.chdir(os.path.join(self.tmp_dir, 'grammars'))
+            # The cache key uses the absolute path of the root file.
+            cached_grammar = self.parse_file(
+                os.path.join(os.pardir, 'grammars', 'main.txt'),
+                cache_dir=cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            os.chdir(saved_cwd)
+            self.assertEqual(cached_grammar.generate_root(), 'hello')
+        finally:
+            os.chdir(saved_cwd)
+
+
+if __name__ == '__main__':
+    unittest.main()
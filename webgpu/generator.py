@@ -26,7 +26,7 @@ import sys
 
 parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
 sys.path.append(parent_dir)
-from grammar import Grammar
+from grammar import Grammar, Template
 
 _N_MAIN_LINES = 1000
 _N_SHADERS = 10
@@ -75,22 +75,28 @@ def generate_function_body(webgpugrammar, num_lines):
 
     return js
 
+def parse_template(template):
+    """Parses a template string, see grammar.Template.parse."""
+    return Template.parse(template, ['webgpufuzz'], 'webgpufuzz',
+                          _N_MAIN_LINES, _N_MAIN_LINES)
+
+
 def generate_new_sample(template, webgpugrammar):
-    result = template
-    while '<webgpufuzz>' in result:
-        result = result.replace(
-            '<webgpufuzz>',
-            generate_function_body(webgpugrammar, _N_MAIN_LINES),
-            1
-        )
+    return template.fill({
+        'webgpufuzz': lambda attributes, sink: generate_function_body(
+            webgpugrammar, int(attributes['lines']))
+    })
 
-    return result
 
+def load_grammar(template, grammar_dir):
+    """Picks the shaders and parses the grammar and the template.
 
-def generate_samples(template, grammar_dir, outfiles):
+    Returns:
+      A (template, grammar) tuple or None if there were errors.
+    """
     extra = ""
     shaders_dir = os.path.join(grammar_dir, "wgsl/*.wgsl")
-    shader_files = glob.glob(shaders_dir)
+    shader_files = sorted(glob.glob(shaders_dir))
 
     shaders = []
     for i in range(_N_SHADERS):
@@ -114,7 +120,17 @@ def generate_samples(template, grammar_dir, outfiles):
     err = webgpugrammar.parse_from_file(os.path.join(grammar_dir, os.path.join(grammar_dir, 'webgpu.txt')), extra)
     if err > 0:
         print('There were errors parsing grammar')
+        return None
+    webgpugrammar.compile_rules()
+
+    return parse_template(template_contents), webgpugrammar
+
+
+def generate_samples(template, grammar_dir, outfiles):
+    loaded = load_grammar(template, grammar_dir)
+    if loaded is None:
         return
+    template_contents, webgpugrammar = loaded
 
     for outfile in outfiles:
         result = generate_new_sample(template_contents, webgpugrammar)